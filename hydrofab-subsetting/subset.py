@@ -6,18 +6,25 @@ Module for subsetting hyfeatures based ngen hydrofabric geopackages.
 @version 0.1
 """
 
+import hashlib
+import importlib.util
+import os
+import sys
+import tempfile
+import threading
 from pathlib import Path
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 import fiona
-from queue import Queue
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
     from typing import List
 
-import networkx as nx
 
 def make_x_walk(hydrofabric):
     """
@@ -25,7 +32,15 @@ def make_x_walk(hydrofabric):
     Args:
         hydrofabric (_type_): _description_
     """
-    attributes = gpd.read_file(hydrofabric, layer="flowpath_attributes").set_index("id")
+    write_x_walk(gpd.read_file(hydrofabric, layer="flowpath_attributes"))
+
+
+def write_x_walk(attributes):
+    """Write crosswalk.json from a flowpath_attributes frame
+    Args:
+        attributes (DataFrame): flowpath_attributes layer
+    """
+    attributes = attributes.set_index("id")
     x_walk = pd.Series(attributes[~attributes["rl_gages"].isna()]["rl_gages"])
 
     data = {}
@@ -45,81 +60,486 @@ def make_geojson(hydrofabric: Path):
     """
     try:
         loader = LoadGDB(hydrofabric)
-        catchments = loader.read_gdb_layer(layer="divides")
-        nexuses = loader.read_gdb_layer(layer="nexus")
-        flowpaths = loader.read_gdb_layer(layer="flowpaths")
-        edge_list = pd.DataFrame(
-            loader.read_gdb_layer(layer="flowpath_edge_list").drop(
-                columns="geometry"
-            )
+        write_geojson(
+            {
+                layer: loader.read_gdb_layer(layer=layer)
+                for layer in (
+                    "divides",
+                    "nexus",
+                    "flowpaths",
+                    "flowpath_edge_list",
+                    "flowpath_attributes",
+                )
+            }
         )
-        make_x_walk(hydrofabric)
-        catchments.to_file("catchments.geojson")
-        nexuses.to_file("nexus.geojson")
-        flowpaths.to_file("flowpaths.geojson")
-        edge_list.to_json("flowpath_edge_list.json", orient="records", indent=2)
     except Exception as e:
         print(f"Unable to use hydrofabric file {hydrofabric}")
         print(str(e))
         raise e
 
 
-def get_upstream_ids(divides, nexus, catchment_id):
+def write_geojson(subsets):
+    """Create the various required geojson/json files from subset layers
+    already in memory, without reading them back from the written geopkg
+    Args:
+        subsets (dict): {layer name: layer frame}, with at least divides,
+            nexus, flowpaths, flowpath_edge_list and flowpath_attributes
+    """
+    edge_list = pd.DataFrame(
+        subsets["flowpath_edge_list"].drop(columns="geometry", errors="ignore")
+    )
+    write_x_walk(subsets["flowpath_attributes"])
+    subsets["divides"].to_file("catchments.geojson")
+    subsets["nexus"].to_file("nexus.geojson")
+    subsets["flowpaths"].to_file("flowpaths.geojson")
+    edge_list.to_json("flowpath_edge_list.json", orient="records", indent=2)
+
+
+def _load_network_traversal():
+    """The catchment/nexus traversal shared with ../subsetting/subset.py,
+    loaded by file path since the hyphenated directories can't be packages
+    """
+    module = sys.modules.get("network_traversal")
+    if module is None:
+        path = Path(__file__).resolve().parent.parent / "subsetting" / "network_traversal.py"
+        spec = importlib.util.spec_from_file_location("network_traversal", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules["network_traversal"] = module
+    return module
+
+
+Topology = _load_network_traversal().Topology
+
+
+def get_upstream_ids(divides, nexus, catchment_id, link_limit=None):
     """Get the ids of the elements upstream from catchment_id
-    Derived from https://github.com/NOAA-OWP/DMOD/blob/3a6da86cac3061116b9a1e2ccdd4a3d01222f0d3/python/lib/modeldata/dmod/modeldata/subset/subset_handler.py#L212
     Args:
         divides (_type_): _description_
         nexus (_type_): _description_
         catchment_id (_type_): _description_
+        link_limit (int): only elements at most this many links upstream
     Returns:
         _type_: _description_
     """
-    # print(divides)
-    nex_index = nexus[["id", "toid"]].set_index(
-        "id"
-    )  # pd.Series(nexus['toid'], index = nexus['id'])#
-    nex_index["toid"] = nex_index["toid"].str.replace("wb", "cat")
-    cat_index = divides[["id", "toid"]].set_index("id")
-    link_limit = None
-    catchment_ids = [catchment_id]
-    graph_nodes = Queue()
-
-    # print(cat_index)
-    # debug = cat_index.reset_index()['id'].str.replace('cat-', '').astype(int).sort_values()
-    # print(debug)
-    # print(debug[ (debug > 113050) & (debug < 113070) ])
-    # import os
-    # os._exit(1)
-    for cid in catchment_ids:
-        graph_nodes.put((catchment_id, 0, True))
-        graph_nodes.put((cat_index.loc[cid].item(), 0, False))
-
-    cat_ids = set()
-    nex_ids = set()
-
-    while graph_nodes.qsize() > 0:
-        item, link_dist, is_catchment = graph_nodes.get()
-        if item is None:
-            continue
-        if is_catchment and item not in cat_ids:
-            cat_ids.add(item)
-            if link_limit is None or link_dist < link_limit:
-                new_dist = link_dist + 1
-                # find the nexus linked to the upstream of this catchment
-                inflow = nex_index[nex_index["toid"] == item].index.unique()
-                if len(inflow) == 1:
-                    graph_nodes.put((inflow[0], new_dist, False))
-                elif len(inflow) > 1:
-                    print("WARNING: Catchment network is not dendridict")
-                # If it is 0, we found a headwater, which is fine...
-        elif not is_catchment and item not in nex_ids:
-            nex_ids.add(item)
-            if link_limit is None or link_dist < link_limit:
-                new_dist = link_dist + 1
-                for c in cat_index[cat_index["toid"] == item].index:
-                    graph_nodes.put((c, new_dist, True))
-
-    return cat_ids, nex_ids
+    return Topology(divides, nexus).upstream(catchment_id, link_limit)
+
+
+def get_downstream_ids(divides, nexus, catchment_id, link_limit=None):
+    """Get the ids of the elements from catchment_id down to its outlet
+    Args:
+        divides (DataFrame): divides layer, with id and toid
+        nexus (DataFrame): nexus layer, with id and toid
+        catchment_id (str): start catchment id
+        link_limit (int): only elements at most this many links downstream
+    Returns:
+        tuple: (cat_ids, nex_ids) sets
+    """
+    return Topology(divides, nexus).downstream(catchment_id, link_limit)
+
+
+def get_upstream_ids_batch(divides, nexus, catchment_ids):
+    """Get the ids of the elements upstream from each of catchment_ids
+    See Topology.upstream_batch, nested basins are only walked once.
+    Args:
+        divides (GeoDataFrame): divides layer, with id and toid
+        nexus (GeoDataFrame): nexus layer, with id and toid
+        catchment_ids (List): outlet catchment ids
+    Returns:
+        dict: {catchment id: (cat_ids, nex_ids)}
+    """
+    return Topology(divides, nexus).upstream_batch(catchment_ids)
+
+
+class UpstreamIndex:
+    """Nested interval numbering of the catchment/nexus network
+    Every catchment and nexus is numbered in depth first order walking
+    upstream, the way Topology.upstream walks it, so everything upstream of
+    a node is the contiguous run of nodes numbered from it up to its end.
+    Subsetting any outlet is then a range lookup, O(size of the subset).
+    Args:
+        ids (ndarray): node ids, in depth first order
+        is_catchment (ndarray): whether each node is a catchment
+        end (ndarray): one past the last node upstream of each node
+        toid (ndarray): position of the nexus each catchment drains to, -1
+            for nexus and catchments without one
+        cat_sorter (ndarray): catchment positions ordered by id
+        source (str): hydrofabric the index was built from
+        version (str): version of source when it was built, see
+            LoadGDB.version
+    """
+
+    def __init__(
+        self, ids, is_catchment, end, toid, cat_sorter, source=None, version=None
+    ):
+        self.ids = ids
+        self.is_catchment = is_catchment
+        self.end = end
+        self.toid = toid
+        self.cat_sorter = cat_sorter
+        self.source = source
+        self.version = version
+        self._cat_ids = ids[cat_sorter]
+
+    @classmethod
+    def from_topology(cls, topology):
+        """Number the network of a Topology
+        Args:
+            topology (Topology): catchment/nexus network
+        """
+        # nodes are (is_catchment, id), catchment and nexus ids are walked
+        # as separate namespaces by Topology.upstream
+        children = {}
+        for cat, nex in topology.cat_toid.items():
+            inflow = list(dict.fromkeys(topology.nex_upstream.get(cat, ())))
+            # catchments fed by several nexus are not walked past
+            children[(True, cat)] = [(False, inflow[0])] if len(inflow) == 1 else []
+            if pd.notna(nex):
+                children.setdefault((False, nex), [])
+        for nex, cat in topology.nex_toid.items():
+            children.setdefault((False, nex), [])
+            if pd.notna(cat):
+                children.setdefault((True, cat), [])
+        for nex, cats in topology.cat_upstream.items():
+            if pd.notna(nex):
+                children[(False, nex)] = [(True, c) for c in dict.fromkeys(cats)]
+
+        upstream_nodes = {c for cs in children.values() for c in cs}
+        roots = [n for n in children if n not in upstream_nodes]
+
+        position = {}
+        order = []
+        end = []
+        # roots first, then whatever a cycle left unnumbered
+        for root in roots + list(children):
+            if root in position:
+                continue
+            stack = [(root, False)]
+            while stack:
+                node, done = stack.pop()
+                if done:
+                    end[position[node]] = len(order)
+                    continue
+                if node in position:
+                    continue
+                position[node] = len(order)
+                order.append(node)
+                end.append(0)
+                stack.append((node, True))
+                stack.extend((c, False) for c in children[node])
+
+        ids = np.array([i for _, i in order], dtype=str)
+        is_catchment = np.array([c for c, _ in order], dtype=bool)
+        toid = np.full(len(order), -1, dtype=np.int64)
+        for cat, nex in topology.cat_toid.items():
+            if pd.notna(nex):
+                toid[position[(True, cat)]] = position[(False, nex)]
+        cats = np.flatnonzero(is_catchment)
+        cat_sorter = cats[np.argsort(ids[cats], kind="stable")]
+        return cls(ids, is_catchment, np.array(end, dtype=np.int64), toid, cat_sorter)
+
+    @classmethod
+    def build(cls, hydrofabric, path=None):
+        """Build the index of a hydrofabric and save it
+        Args:
+            hydrofabric (Path): path or s3 link to hydrofabric geopkg
+            path (str): index file, default
+                {hydrofabric name}_upstream_index.npz in the working directory
+        Returns:
+            UpstreamIndex: the index
+        """
+        index = cls.from_loader(LoadGDB(hydrofabric))
+        if path is None:
+            path = f"{Path(str(hydrofabric)).stem}_upstream_index.npz"
+        index.save(path)
+        return index
+
+    @classmethod
+    def from_loader(cls, loader):
+        """Build the index of the hydrofabric read by loader
+        Args:
+            loader (LoadGDB): hydrofabric loader
+        """
+        index = cls.from_topology(
+            Topology(read_topology(loader, "divides"), read_topology(loader, "nexus"))
+        )
+        index.source = _index_source(loader)
+        index.version = loader.version()
+        return index
+
+    def save(self, path):
+        """Write the index to an .npz file"""
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                ids=self.ids,
+                is_catchment=self.is_catchment,
+                end=self.end,
+                toid=self.toid,
+                cat_sorter=self.cat_sorter,
+                source=np.array(self.source or ""),
+                version=np.array(self.version or ""),
+            )
+
+    @classmethod
+    def load(cls, path, loader=None):
+        """Read an index written by save
+        Args:
+            path (str): index file
+            loader (LoadGDB): hydrofabric the index has to be built from,
+                not checked if None
+        Raises:
+            ValueError: the index was built from another hydrofabric, or an
+                older version of it
+        """
+        with np.load(path) as arrays:
+            fields = {k: arrays[k] for k in arrays.files}
+        for k in ("source", "version"):
+            # indices saved before these were recorded have neither
+            fields[k] = str(fields[k]) if k in fields else None
+        index = cls(**fields)
+        if loader is not None and not index.built_from(loader):
+            raise ValueError(
+                f"Upstream index {path} was built from {index.source} "
+                f"(version {index.version}), not {_index_source(loader)} "
+                f"(version {loader.version()}), rebuild it with --build-index"
+            )
+        return index
+
+    def built_from(self, loader):
+        """Whether the index is of the current version of loader's hydrofabric"""
+        return self.source == _index_source(loader) and self.version == loader.version()
+
+    def upstream(self, catchment_id):
+        """Same result as Topology.upstream(catchment_id) on the network the
+        index was built from
+        Args:
+            catchment_id (str): outlet catchment id
+        Returns:
+            tuple: (cat_ids, nex_ids) sets
+        """
+        i = np.searchsorted(self._cat_ids, catchment_id)
+        if i == len(self._cat_ids) or self._cat_ids[i] != catchment_id:
+            raise KeyError(catchment_id)
+        start = self.cat_sorter[i]
+        if self.toid[start] >= 0:
+            # the outlet nexus, with every catchment draining to it
+            start = self.toid[start]
+        stop = self.end[start]
+        ids = self.ids[start:stop]
+        is_catchment = self.is_catchment[start:stop]
+        return set(ids[is_catchment].tolist()), set(ids[~is_catchment].tolist())
+
+
+def _index_source(loader):
+    """Hydrofabric an index built from loader records, local paths absolute"""
+    if loader.isS3:
+        return str(loader.path)
+    return os.path.abspath(loader.path)
+
+
+def _upstream_index(index, loader):
+    """UpstreamIndex from an index or the path of an index file, rebuilt
+    (and saved over the file) if it is not of loader's hydrofabric
+    """
+    path = None
+    if not isinstance(index, UpstreamIndex):
+        path = index
+        index = UpstreamIndex.load(path)
+    if index.built_from(loader):
+        return index
+
+    print(f"Upstream index is stale for {_index_source(loader)}, rebuilding it")
+    index = UpstreamIndex.from_loader(loader)
+    if path is not None:
+        index.save(path)
+    return index
+
+
+# Layers written to a subset, {output layer: (hydrofabric layer, ids to keep)}
+SUBSET_LAYERS = {
+    "flowpaths": ("flowpaths", "wb"),
+    "divides": ("divides", "cat"),
+    "nexus": ("nexus", "nex"),
+    "crosswalk": ("network_lookup", "wb"),  # v1.2
+    "flowpath_edge_list": ("network", "nex+wb"),
+    "flowpath_attributes": ("flowpath_attributes", "wb"),
+    "cfe_noahowp_attributes": ("cfe_noahowp_attributes", "cat"),
+    "forcing_metadata": ("forcing_metadata", "cat"),
+}
+
+
+def subset_index(cat_ids, nex_ids):
+    """Index keys used to subset each kind of hydrofabric layer
+    Args:
+        cat_ids (set): catchment ids in the subset
+        nex_ids (set): nexus ids in the subset
+    Returns:
+        dict: {"cat", "nex", "wb", "nex+wb": list of ids}
+    """
+    # As long as these remain 1-1 this works, but that may not always be the case
+    # FIXME in fact this isn't true at all, there can be catchments with no FP, and FP with no catchment
+    wb_ids = list(map(lambda x: x.replace("cat", "wb"), cat_ids))
+    # To use as pandas indicies, it really wants list, not set
+    cat_ids = list(cat_ids)
+    nex_ids = list(nex_ids)
+    return {"cat": cat_ids, "nex": nex_ids, "wb": wb_ids, "nex+wb": nex_ids + wb_ids}
+
+
+def write_subset(name, subsets):
+    """Write subset layers to a geopackage
+    With pyogrio each layer is written in a single transaction, through
+    Arrow when pyarrow is installed and GDAL supports Arrow writes (3.8+),
+    and SQLite syncs are turned off for the duration of the write so layers
+    are not flushed to disk one by one.
+    Args:
+        name (str): output geopackage
+        subsets (dict): {layer name: layer frame}
+    """
+    try:
+        import pyogrio
+    except ImportError:
+        for layer, frame in subsets.items():
+            frame.to_file(name, layer=layer)
+        return
+
+    try:
+        import pyarrow  # noqa: F401
+
+        # older GDAL raises on arrow writes rather than falling back
+        use_arrow = pyogrio.__gdal_version__ >= (3, 8, 0)
+    except ImportError:
+        use_arrow = False
+
+    option = "OGR_SQLITE_SYNCHRONOUS"
+    previous = pyogrio.get_gdal_config_option(option)
+    pyogrio.set_gdal_config_options({option: "OFF"})
+    try:
+        for layer, frame in subsets.items():
+            pyogrio.write_dataframe(
+                frame, name, layer=layer, driver="GPKG", use_arrow=use_arrow
+            )
+    finally:
+        pyogrio.set_gdal_config_options({option: previous})
+
+
+def _where_in(column, values):
+    """SQL WHERE clause matching column against values"""
+    quoted = ", ".join("'" + str(v).replace("'", "''") + "'" for v in values)
+    return f'"{column}" IN ({quoted})'
+
+
+class HydrofabricCache:
+    """Size-bounded local cache of whole remote hydrofabric files
+    Files are stored under a name derived from the remote path and its ETag,
+    so a republished object is downloaded again while an unchanged one is
+    read from local disk. The least recently used files are evicted once
+    the cache holds more than max_bytes.
+    Args:
+        directory (str): cache directory
+        max_bytes (int): cache size limit in bytes
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def fetch(self, fs, path, version):
+        """Local path of a cached copy of path on filesystem fs
+        Args:
+            fs (fsspec.AbstractFileSystem): remote filesystem
+            path (str): remote path
+            version (str): ETag of path, see LoadGDB.version
+        Returns:
+            str: path of the local copy
+        """
+        key = hashlib.sha256(f"{path}:{version}".encode()).hexdigest()
+        local = self.directory / (key + Path(str(path)).suffix)
+
+        with self._lock:
+            if local.exists():
+                os.utime(local)  # mark as recently used
+                return str(local)
+
+            self.directory.mkdir(parents=True, exist_ok=True)
+            download = local.with_name(local.name + ".part")
+            try:
+                fs.get(path, str(download))
+                os.replace(download, local)
+            finally:
+                # left behind only if the download failed
+                download.unlink(missing_ok=True)
+            self._evict(keep=local)
+        return str(local)
+
+    def _evict(self, keep):
+        # only files named by fetch, so a cache directory pointed at other
+        # data never loses anything else
+        files = [f for f in self.directory.iterdir() if self._is_entry(f)]
+        files.sort(key=lambda f: f.stat().st_mtime)
+        total = sum(f.stat().st_size for f in files)
+        for f in files:
+            if total <= self.max_bytes:
+                break
+            if f != keep:
+                total -= f.stat().st_size
+                f.unlink()
+
+    @staticmethod
+    def _is_entry(f):
+        """Whether f is a complete cache entry, <sha256 hex><suffix>"""
+        stem, _, suffix = f.name.partition(".")
+        return (
+            f.is_file()
+            and len(stem) == 64
+            and all(c in "0123456789abcdef" for c in stem)
+            and not suffix.endswith("part")
+        )
+
+
+# Shared by every LoadGDB in the process
+HYDROFABRIC_CACHE = HydrofabricCache(
+    os.environ.get(
+        "HYDROFABRIC_CACHE_DIR",
+        os.path.join(tempfile.gettempdir(), "hydrofabric_cache"),
+    ),
+    int(os.environ.get("HYDROFABRIC_CACHE_BYTES", 50 * 2**30)),
+)
+
+
+def read_topology(loader, layer, topology_only=True, columns=("toid",)):
+    """Read the layer columns needed to walk the network
+    Args:
+        loader (LoadGDB): hydrofabric loader
+        layer (str): layer name
+        topology_only (bool): read only id and columns, without geometry,
+            otherwise read the full layer
+        columns (List): topology columns besides id
+    """
+    if topology_only:
+        return loader.read_gdb_layer(layer=layer, columns=columns, geometry=False)
+    return loader.read_gdb_layer(layer=layer)
+
+
+def read_layers(loader, layers, max_workers=None):
+    """Read several layers concurrently
+    GDAL reads are I/O bound and release the GIL, so threads are enough.
+    Args:
+        loader (LoadGDB): hydrofabric loader
+        layers (dict): {name: read_gdb_layer keyword arguments}
+        max_workers (int): threads, one per layer if None
+    Returns:
+        dict: {name: layer frame}
+    """
+    if not layers:
+        return {}
+    with ThreadPoolExecutor(max_workers=max_workers or len(layers)) as pool:
+        futures = {
+            name: pool.submit(loader.read_gdb_layer, **kwargs)
+            for name, kwargs in layers.items()
+        }
+        return {name: future.result() for name, future in futures.items()}
 
 
 # (tony) adding support for s3
@@ -130,16 +550,75 @@ class LoadGDB():
         import boto3
         import fsspec
         self.isS3 = False
-        self.path = path
+        self.path = str(path)
+        self._version = None
+        self._version_lock = threading.Lock()
         if path[0:3] == 's3:':
             self.isS3 = True
             self.s3 = boto3.resource('s3')
             self.s3 = fsspec.filesystem('s3', anon=True)    
 
-    def read_gdb_layer(self, layer):
+    # ids per WHERE clause, keeps the generated SQL a manageable size
+    max_ids_per_query = 10000
+
+    def read_gdb_layer(
+        self, layer, ids=None, columns=None, id_column="id", geometry=True
+    ):
+        """Read a layer, optionally only the rows whose id_column is in ids
+        and only the given (non-geometry) columns. The id filter is handed
+        to GDAL as a WHERE clause so unmatched rows are never materialized.
+        Args:
+            layer (str): layer name
+            ids (List): ids of the rows to read, all rows if None
+            columns (List): columns to read, all columns if None
+            id_column (str): column ids are matched against
+            geometry (bool): read the geometry column, a DataFrame is
+                returned without it
+        """
+        kwargs = {}
+        if not geometry:
+            kwargs["ignore_geometry"] = True
+        if columns is not None:
+            kwargs["columns"] = list(dict.fromkeys([id_column, *columns]))
+        if ids is None:
+            return self._read_layer(layer, **kwargs)
+
+        ids = list(dict.fromkeys(ids))
+        chunks = [
+            self._read_layer(layer, where=_where_in(id_column, chunk), **kwargs)
+            for chunk in (
+                ids[i : i + self.max_ids_per_query]
+                for i in range(0, len(ids), self.max_ids_per_query)
+            )
+        ]
+        if not chunks:
+            return self._read_layer(layer, where="0 = 1", **kwargs)
+        if len(chunks) == 1:
+            return chunks[0]
+        return pd.concat(chunks, ignore_index=True)
+
+    def _read_layer(self, layer, **kwargs):
         if self.isS3:
-            return self._get_layer_from_s3(layer)
-        return gpd.read_file(self.path, layer=layer)
+            return self._get_layer_from_s3(layer, **kwargs)
+        return gpd.read_file(self.path, layer=layer, **kwargs)
+
+    def version(self):
+        """Version of the hydrofabric file, the ETag of an s3 object (size
+        and modification time if it has none) or the size and modification
+        time of a local file. The remote object is only asked once per
+        loader, so reading many layers costs a single request.
+        """
+        if not self.isS3:
+            stat = os.stat(self.path)
+            return f"{stat.st_size}-{stat.st_mtime_ns}"
+        with self._version_lock:
+            if self._version is None:
+                info = self.s3.info(self.path)
+                self._version = (
+                    info.get("ETag")
+                    or f'{info.get("size")}-{info.get("LastModified")}'
+                )
+        return self._version
 
     def list_gdb_layers(self):
         if self.isS3:
@@ -147,20 +626,37 @@ class LoadGDB():
         return fiona.listlayers(self.path)
             
     def __s3_open(self):
-        return self.s3.open(self.path)
+        # local copy of the remote hydrofabric, downloaded once per ETag and
+        # shared by all LoadGDB instances
+        return HYDROFABRIC_CACHE.fetch(self.s3, self.path, self.version())
     
     def _list_layers_from_s3(self):
         return fiona.listlayers(self.__s3_open())
         
-    def _get_layer_from_s3(self, layer):
-        return gpd.read_file(self.__s3_open(), layer=layer)
+    def _get_layer_from_s3(self, layer, **kwargs):
+        return gpd.read_file(self.__s3_open(), layer=layer, **kwargs)
 # end -------------------------------
 
-def subset_upstream(hydrofabric: Path, ids: "List") -> None:
+def subset_upstream(
+    hydrofabric: Path,
+    ids: "List",
+    topology_only: bool = True,
+    index=None,
+    max_workers: int = None,
+    link_limit: int = None,
+) -> None:
     """
     Args:
         hydrofabric (_type_): _description_
         ids (List): _description_
+        topology_only (bool): walk the network on the id/toid columns only
+            and read divides and nexus geometries for the selected ids
+            afterwards, instead of loading both layers in full
+        index (UpstreamIndex or str): index of the hydrofabric, or its file,
+            to look the upstream ids up in instead of walking the network
+        max_workers (int): threads reading layers, one per layer if None
+        link_limit (int): only subset this many links upstream, the index
+            holds whole upstream networks so it is not used with a limit
     """
     
 
@@ -168,18 +664,16 @@ def subset_upstream(hydrofabric: Path, ids: "List") -> None:
     # begin -------------------------------
     loader = LoadGDB(hydrofabric)
     layers  = loader.list_gdb_layers()
-    divides = loader.read_gdb_layer(layer='divides')
-    nexus   = loader.read_gdb_layer(layer='nexus')
+    if index is None or link_limit is not None:
+        divides = read_topology(loader, "divides", topology_only)
+        nexus = read_topology(loader, "nexus", topology_only)
     # end -------------------------------
-        
-    cat_ids, nex_ids = get_upstream_ids(divides, nexus, ids)
-    # As long as these remain 1-1 this works, but that may not always be the case
-    # FIXME in fact this isn't true at all, there can be catchments with no FP, and FP with no catchment
-    wb_ids = list(map(lambda x: x.replace("cat", "wb"), cat_ids))
 
-    # To use as pandas indicies, it really wants list, not set
-    cat_ids = list(cat_ids)
-    nex_ids = list(nex_ids)
+    if index is None or link_limit is not None:
+        cat_ids, nex_ids = Topology(divides, nexus).upstream(ids, link_limit)
+    else:
+        cat_ids, nex_ids = _upstream_index(index, loader).upstream(ids)
+        topology_only = True
     # Now have the index keys to subset the entire hydrofabric
     # print("Subset ids:")
     # print(cat_ids)
@@ -191,61 +685,222 @@ def subset_upstream(hydrofabric: Path, ids: "List") -> None:
         print(layer)
     #     print(df.head())
 
-    flowpaths = (
-        loader.read_gdb_layer(layer="flowpaths")         # (tony) adding support for s3
-        .set_index("id")
-        .loc[wb_ids]
-        .reset_index()
+    frames = {}
+    if not topology_only:
+        frames = {"divides": divides, "nexus": nexus}
+    _subset_layers(
+        loader, f"{ids}_upstream_subset.gpkg", cat_ids, nex_ids, frames, max_workers
     )
-    divides = divides.set_index("id").loc[cat_ids].reset_index()
-    nexus = nexus.set_index("id").loc[nex_ids].reset_index()
-    # lookup_table = gpd.read_file(hydrofabric, layer='lookup_table').set_index('id').loc[wb_ids].reset_index() v1.0???
 
-       
-    crosswalk = (
-        loader.read_gdb_layer(layer="network_lookup")  # (tony) adding support for s3
-        .set_index("id")
-        .loc[wb_ids]
-        .reset_index()
-    )  # v1.2
-    flowpath_edge_list = (
-       loader.read_gdb_layer(layer="network") # (tony) adding support for s3
-        .set_index("id")
-        .loc[nex_ids + wb_ids]
-        .reset_index()
-    )
-    flowpath_attributes = (
-        loader.read_gdb_layer(layer="flowpath_attributes") # (tony) adding support for s3
-        .set_index("id")
-        .loc[wb_ids]
-        .reset_index()
+
+def subset_downstream(
+    hydrofabric: Path,
+    ids: "List",
+    topology_only: bool = True,
+    max_workers: int = None,
+    link_limit: int = None,
+) -> None:
+    """
+    Subset the hydrofabric from a catchment down to its outlet, writing
+    {id}_downstream_subset.gpkg and the ngen geojson files.
+    Args:
+        hydrofabric (Path): path or s3 link to hydrofabric geopkg
+        ids (str): start catchment id
+        topology_only (bool): see subset_upstream
+        max_workers (int): see subset_upstream
+        link_limit (int): only subset this many links downstream
+    """
+    loader = LoadGDB(hydrofabric)
+    divides = read_topology(loader, "divides", topology_only)
+    nexus = read_topology(loader, "nexus", topology_only)
+    cat_ids, nex_ids = Topology(divides, nexus).downstream(ids, link_limit)
+
+    frames = {}
+    if not topology_only:
+        frames = {"divides": divides, "nexus": nexus}
+    _subset_layers(
+        loader, f"{ids}_downstream_subset.gpkg", cat_ids, nex_ids, frames, max_workers
     )
-    model_attributes = (
-        loader.read_gdb_layer(layer="cfe_noahowp_attributes") # (tony) adding support for s3
-        .set_index("id")
-        .loc[cat_ids]
-        .reset_index()
+
+
+def _subset_layers(loader, name, cat_ids, nex_ids, frames, max_workers):
+    """Subset every layer to the given ids and write them to name along with
+    the ngen geojson files
+    Args:
+        loader (LoadGDB): hydrofabric loader
+        name (str): output geopackage
+        cat_ids (set): catchment ids in the subset
+        nex_ids (set): nexus ids in the subset
+        frames (dict): {layer: frame} of layers already read in full
+        max_workers (int): see subset_upstream
+    """
+    # the layers are independent once the ids are known, read them all at
+    # once so the wall time is that of the slowest layer
+    keys = subset_index(cat_ids, nex_ids)
+    reads = {
+        layer: {"layer": source, "ids": keys[kind]}
+        for layer, (source, kind) in SUBSET_LAYERS.items()
+    }
+    frames = dict(frames)
+    frames.update(
+        read_layers(
+            loader,
+            {k: v for k, v in reads.items() if k not in frames},
+            max_workers,
+        )
     )
+    # lookup_table = gpd.read_file(hydrofabric, layer='lookup_table').set_index('id').loc[wb_ids].reset_index() v1.0???
     # forcing_attributes = gpd.read_file(hydrofabric, layer='forcing_attributes').set_index('id').loc[cat_ids].reset_index() v1.0
-    forcing_meta = (
-        loader.read_gdb_layer(layer="forcing_metadata") # (tony) adding support for s3
-        .set_index("id")
-        .loc[cat_ids]
-        .reset_index()
+    subsets = {
+        layer: frames[layer].set_index("id").loc[reads[layer]["ids"]].reset_index()
+        for layer in SUBSET_LAYERS
+    }
+    write_subset(name, subsets)
+
+    write_geojson(subsets)
+
+def subset_upstream_batch(
+    hydrofabric: Path,
+    ids: "List",
+    single_file: bool = False,
+    topology_only: bool = True,
+    index=None,
+    max_workers: int = None,
+    link_limit: int = None,
+) -> None:
+    """
+    Subset the hydrofabric upstream of many outlets, reading every layer once.
+    Writes {id}_upstream_subset.gpkg per outlet, or with single_file a single
+    upstream_subsets.gpkg where each layer has a basin_id column naming the
+    outlet a row was subset for (rows repeat for nested basins).
+    Args:
+        hydrofabric (Path): path or s3 link to hydrofabric geopkg
+        ids (List): outlet catchment ids
+        single_file (bool): write all subsets to one geopackage
+        topology_only (bool): see subset_upstream
+        index (UpstreamIndex or str): see subset_upstream
+        max_workers (int): see subset_upstream
+        link_limit (int): see subset_upstream
+    """
+    subset_batch(
+        hydrofabric,
+        ids,
+        "upstream",
+        single_file,
+        topology_only,
+        index,
+        max_workers,
+        link_limit,
     )
-    name = f"{ids}_upstream_subset.gpkg"
 
-    flowpaths.to_file(name, layer="flowpaths")
-    divides.to_file(name, layer="divides")
-    nexus.to_file(name, layer="nexus")
-    # lookup_table.to_file(name, layer="lookup_table")
-    crosswalk.to_file(name, layer="crosswalk")
-    flowpath_edge_list.to_file(name, layer="flowpath_edge_list")
-    flowpath_attributes.to_file(name, layer="flowpath_attributes")
-    model_attributes.to_file(name, layer="cfe_noahowp_attributes")
-    forcing_meta.to_file(name, layer="forcing_metadata")
 
-    make_geojson(name)
+def subset_downstream_batch(
+    hydrofabric: Path,
+    ids: "List",
+    single_file: bool = False,
+    topology_only: bool = True,
+    max_workers: int = None,
+    link_limit: int = None,
+) -> None:
+    """
+    Subset the hydrofabric from many catchments down to their outlets,
+    reading every layer once, see subset_upstream_batch.
+    Args:
+        hydrofabric (Path): path or s3 link to hydrofabric geopkg
+        ids (List): start catchment ids
+        single_file (bool): write all subsets to one geopackage
+        topology_only (bool): see subset_upstream
+        max_workers (int): see subset_upstream
+        link_limit (int): see subset_downstream
+    """
+    subset_batch(
+        hydrofabric,
+        ids,
+        "downstream",
+        single_file,
+        topology_only,
+        max_workers=max_workers,
+        link_limit=link_limit,
+    )
+
+
+def subset_batch(
+    hydrofabric: Path,
+    ids: "List",
+    mode: str = "upstream",
+    single_file: bool = False,
+    topology_only: bool = True,
+    index=None,
+    max_workers: int = None,
+    link_limit: int = None,
+) -> None:
+    """
+    Subset the hydrofabric from many catchments, reading every layer once and
+    walking one Topology for all of them. Writes {id}_{mode}_subset.gpkg per
+    catchment, or with single_file a single {mode}_subsets.gpkg where each
+    layer has a basin_id column naming the catchment a row was subset for.
+    Args:
+        hydrofabric (Path): path or s3 link to hydrofabric geopkg
+        ids (List): catchment ids
+        mode (str): "upstream" or "downstream"
+        single_file (bool): write all subsets to one geopackage
+        topology_only (bool): see subset_upstream
+        index (UpstreamIndex or str): see subset_upstream, only used for
+            upstream subsets without a link_limit
+        max_workers (int): see subset_upstream
+        link_limit (int): only subset this many links from each id
+    """
+    loader = LoadGDB(hydrofabric)
+    if index is None or mode != "upstream" or link_limit is not None:
+        divides = read_topology(loader, "divides", topology_only)
+        nexus = read_topology(loader, "nexus", topology_only)
+        selected = Topology(divides, nexus).subsets(ids, mode, link_limit)
+    else:
+        index = _upstream_index(index, loader)
+        selected = {c: index.upstream(c) for c in ids}
+        topology_only = True
+
+    # only read the rows of each layer that some outlet needs
+    needed = defaultdict(set)
+    for cat_ids, nex_ids in selected.values():
+        for kind, keys in subset_index(cat_ids, nex_ids).items():
+            needed[kind].update(keys)
+
+    frames = {}
+    if not topology_only:
+        frames = {"divides": divides.set_index("id"), "nexus": nexus.set_index("id")}
+    reads = {
+        source: {"layer": source, "ids": needed[kind]}
+        for source, kind in SUBSET_LAYERS.values()
+        if source not in frames
+    }
+    for source, frame in read_layers(loader, reads, max_workers).items():
+        frames[source] = frame.set_index("id")
+
+    basins = {layer: [] for layer in SUBSET_LAYERS}
+    for outlet, (cat_ids, nex_ids) in selected.items():
+        print(f"Subsetting {mode} of {outlet}")
+        index = subset_index(cat_ids, nex_ids)
+        subsets = {
+            layer: frames[source].loc[index[kind]].reset_index()
+            for layer, (source, kind) in SUBSET_LAYERS.items()
+        }
+        if single_file:
+            for layer, frame in subsets.items():
+                frame.insert(0, "basin_id", outlet)
+                basins[layer].append(frame)
+        else:
+            write_subset(f"{outlet}_{mode}_subset.gpkg", subsets)
+
+    if single_file:
+        write_subset(
+            f"{mode}_subsets.gpkg",
+            {
+                layer: pd.concat(parts, ignore_index=True)
+                for layer, parts in basins.items()
+            },
+        )
+
 
 def get_upstream_ids_prerelease(nexus, flow, catchment_id):
 
@@ -256,24 +911,59 @@ def get_upstream_ids_prerelease(nexus, flow, catchment_id):
     flow = flow.rename(columns={'id': 'wb-id', 'toid': 'to-nexus'})
     merged = nexus.merge(flow, on=['wb-id', 'wb-id'], how='outer')
     
-    # create directional graph of these data, build graph in reverse order
+    # directional graph of these data in reverse order, as edge arrays: each
+    # row adds to-nexus -> from-nexus (when there is one) then
+    # to-nexus -> wb-id, matching the order networkx would have seen them
     print('Building Graph Network')
-    G = nx.DiGraph()
-    for idx, row in merged.iterrows():
-        if not pd.isnull(row['from-nexus']):
-            G.add_edge(row['to-nexus'], row['from-nexus'])
-        G.add_edge(row['to-nexus'], row['wb-id'], divide_id=row['divide_id'])
+    to_nexus = merged['to-nexus'].to_numpy()
+    has_nexus = merged['from-nexus'].notna().to_numpy()
+    sources = np.concatenate([to_nexus[has_nexus], to_nexus])
+    targets = np.concatenate(
+        [merged['from-nexus'].to_numpy()[has_nexus], merged['wb-id'].to_numpy()]
+    )
+    order = np.concatenate(
+        [2 * np.flatnonzero(has_nexus), 2 * np.arange(len(merged)) + 1]
+    )
+    keep = pd.notna(sources) & pd.notna(targets)
+    sources, targets, order = sources[keep], targets[keep], order[keep]
+
+    # compact adjacency: node codes and CSR offsets into the successors
+    codes, nodes = pd.factorize(np.concatenate([sources, targets]))
+    nodes = pd.Index(nodes)
+    source_codes, target_codes = codes[: len(sources)], codes[len(sources) :]
+    by_source = np.lexsort((order, source_codes))
+    successors = target_codes[by_source]
+    offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(source_codes, minlength=len(nodes)), out=offsets[1:])
 
     # get starting node
     start_nexus = merged.loc[merged['wb-id'] == catchment_id]['to-nexus'].item()
 
-    # perform depth first search
-    subG = nx.dfs_tree(G, start_nexus)
+    # perform depth first search, nodes in the order nx.dfs_tree finds them
+    start = nodes.get_loc(start_nexus) if start_nexus in nodes else None
+    found = []
+    if start is None:
+        found.append(start_nexus)
+    else:
+        visited = np.zeros(len(nodes), dtype=bool)
+        visited[start] = True
+        found.append(start)
+        stack = [iter(successors[offsets[start] : offsets[start + 1]])]
+        while stack:
+            for child in stack[-1]:
+                if not visited[child]:
+                    visited[child] = True
+                    found.append(child)
+                    stack.append(iter(successors[offsets[child] : offsets[child + 1]]))
+                    break
+            else:
+                stack.pop()
+        found = nodes[found].tolist()
 
     # separate wb- and nex- elements into lists
     wbs = []
     nex = []
-    for i in list(subG.nodes()):
+    for i in found:
         if i[0:2] == 'wb':
             wbs.append(i)
         else:
@@ -285,12 +975,15 @@ def get_upstream_ids_prerelease(nexus, flow, catchment_id):
     
     return wbs, nex
     
-def subset_upstream_prerelease(hydrofabric: Path, ids: "List") -> None:
+def subset_upstream_prerelease(
+    hydrofabric: Path, ids: "List", topology_only: bool = True
+) -> None:
     """
     Function to peform hydrofabric subsetting on the "pre-release" dataset.
     Args:
         hydrofabric (_type_): _description_
         ids (List): _description_
+        topology_only (bool): see subset_upstream
     """
     
 
@@ -298,9 +991,8 @@ def subset_upstream_prerelease(hydrofabric: Path, ids: "List") -> None:
     # begin -------------------------------
     loader = LoadGDB(hydrofabric)
     layers  = loader.list_gdb_layers()
-    divides = loader.read_gdb_layer(layer='divides')
-    nexus   = loader.read_gdb_layer(layer='nexus')
-    flow = loader.read_gdb_layer(layer='flowpaths')
+    nexus = read_topology(loader, "nexus", topology_only)
+    flow = read_topology(loader, "flowpaths", topology_only, ["toid", "divide_id"])
     # end -------------------------------
 
     # trace upstream
@@ -312,20 +1004,27 @@ def subset_upstream_prerelease(hydrofabric: Path, ids: "List") -> None:
     
     print('Subsetting Flowpaths')
     flowpaths = (
-        loader.read_gdb_layer(layer="flowpaths")         
+        loader.read_gdb_layer(layer="flowpaths", ids=wb_ids)
         .set_index("id")
         .loc[wb_ids]
         .reset_index()
     )
     print('Subsetting Divides')
-    divides = divides.set_index("id").loc[wb_ids].reset_index()
+    divides = (
+        loader.read_gdb_layer(layer="divides", ids=wb_ids)
+        .set_index("id")
+        .loc[wb_ids]
+        .reset_index()
+    )
     
     print('Subsetting Nexus')
+    if topology_only:
+        nexus = loader.read_gdb_layer(layer="nexus", ids=nex_ids)
     nexus = nexus.set_index("id").loc[nex_ids].reset_index()
  
     print('Subsetting Crosswalk')
     crosswalk = (
-        loader.read_gdb_layer(layer="network_lookup")  
+        loader.read_gdb_layer(layer="network_lookup", ids=wb_ids)
         .set_index("id")
         .loc[wb_ids]
         .reset_index()
@@ -333,7 +1032,7 @@ def subset_upstream_prerelease(hydrofabric: Path, ids: "List") -> None:
     
     print('Subsetting Edge List')
     flowpath_edge_list = (
-       loader.read_gdb_layer(layer="network") 
+       loader.read_gdb_layer(layer="network", ids=nex_ids + wb_ids)
         .set_index("id")
         .loc[nex_ids + wb_ids]
         .reset_index()
@@ -341,7 +1040,7 @@ def subset_upstream_prerelease(hydrofabric: Path, ids: "List") -> None:
 
     print('Subsetting Flowpath Attributes')
     flowpath_attributes = (
-        loader.read_gdb_layer(layer="flowpath_attributes") 
+        loader.read_gdb_layer(layer="flowpath_attributes", ids=wb_ids)
         .set_index("id")
         .loc[wb_ids]
         .reset_index()
@@ -350,7 +1049,9 @@ def subset_upstream_prerelease(hydrofabric: Path, ids: "List") -> None:
     print('Subsetting Model Attributes')
     cat_ids = list(map(lambda x: x.replace("wb", "cat"), wb_ids))
     model_attributes = (
-        loader.read_gdb_layer(layer="cfe_noahowp_attributes") 
+        loader.read_gdb_layer(
+            layer="cfe_noahowp_attributes", ids=cat_ids, id_column="divide_id"
+        )
         .set_index("divide_id")
         .loc[cat_ids]
         .reset_index()
@@ -383,17 +1084,20 @@ def subset_upstream_prerelease(hydrofabric: Path, ids: "List") -> None:
     # save outputs 
     print('Saving Subsets to GeoPackage')
     name = f"{ids}_upstream_subset.gpkg"
-    flowpaths.to_file(name, layer="flowpaths")
-    divides.to_file(name, layer="divides")
-    nexus.to_file(name, layer="nexus")
-    crosswalk.to_file(name, layer="crosswalk")
-    flowpath_edge_list.to_file(name, layer="flowpath_edge_list")
-    flowpath_attributes.to_file(name, layer="flowpath_attributes")
-    model_attributes.to_file(name, layer="cfe_noahowp_attributes")
+    subsets = {
+        "flowpaths": flowpaths,
+        "divides": divides,
+        "nexus": nexus,
+        "crosswalk": crosswalk,
+        "flowpath_edge_list": flowpath_edge_list,
+        "flowpath_attributes": flowpath_attributes,
+        "cfe_noahowp_attributes": model_attributes,
+    }
+    write_subset(name, subsets)
     
     # make geojsons
     print('Saving Geo JSON')
-    make_geojson(name)
+    write_geojson(subsets)
     
 if __name__ == "__main__":
     import argparse
@@ -401,13 +1105,75 @@ if __name__ == "__main__":
     # get the command line parser
     parser = argparse.ArgumentParser(description="Subset provided hydrofabric")
     parser.add_argument(
-        "hydrofabric", type=Path, help="Path or link to hydrofabric geopkg to"
+        "hydrofabric", type=str, help="Path or link to hydrofabric geopkg to"
     )
     # TODO make this a group, pick the type of subset to do...
-    # TODO allow multiple inputs for upstream?
     # TODO custom validate type to ensure it is a valid identifier?
-    parser.add_argument("upstream", type=str, help="id to subset upstream from")
-    
+    parser.add_argument(
+        "upstream", type=str, nargs="*", help="id(s) to subset upstream from"
+    )
+    parser.add_argument(
+        "--single-file",
+        action="store_true",
+        help="write all subsets to one geopkg with a basin_id column",
+    )
+    parser.add_argument(
+        "--index", help="upstream index file to look subsets up in"
+    )
+    parser.add_argument(
+        "--build-index",
+        action="store_true",
+        help="build the upstream index (at --index if given) before subsetting",
+    )
+    parser.add_argument(
+        "--workers", type=int, help="threads reading layers, one per layer by default"
+    )
+    parser.add_argument(
+        "--downstream",
+        action="store_true",
+        help="subset from each id down to its outlet instead of upstream",
+    )
+    parser.add_argument(
+        "--link-limit", type=int, help="only subset this many links from each id"
+    )
 
     args = parser.parse_args()
-    subset_upstream(args.hydrofabric, args.upstream)
+    if (args.index or args.build_index) and (
+        args.downstream or args.link_limit is not None
+    ):
+        parser.error(
+            "the upstream index holds whole upstream networks, "
+            "it can't be used with --downstream or --link-limit"
+        )
+    index = args.index
+    if args.build_index:
+        index = UpstreamIndex.build(str(args.hydrofabric), args.index)
+    if not args.upstream:
+        if not args.build_index:
+            parser.error("no ids to subset upstream from")
+    elif len(args.upstream) == 1 and not args.single_file:
+        if args.downstream:
+            subset_downstream(
+                args.hydrofabric,
+                args.upstream[0],
+                max_workers=args.workers,
+                link_limit=args.link_limit,
+            )
+        else:
+            subset_upstream(
+                args.hydrofabric,
+                args.upstream[0],
+                index=index,
+                max_workers=args.workers,
+                link_limit=args.link_limit,
+            )
+    else:
+        subset_batch(
+            args.hydrofabric,
+            args.upstream,
+            "downstream" if args.downstream else "upstream",
+            args.single_file,
+            index=index,
+            max_workers=args.workers,
+            link_limit=args.link_limit,
+        )
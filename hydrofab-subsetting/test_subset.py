@@ -0,0 +1,44 @@
+"""Checks of the hydrofabric subset lookups against the network traversal"""
+
+import numpy as np
+import pandas as pd
+
+from subset import Topology, UpstreamIndex
+
+
+def random_network(n, seed=0):
+    # a forest of catchments, each draining through its own nexus into a
+    # random downstream catchment; some catchments and nexus have no toid
+    rng = np.random.default_rng(seed)
+    cats = [f"cat-{i}" for i in range(n)]
+    cat_toid = [f"nex-{i}" if rng.random() > 0.1 else np.nan for i in range(n)]
+    nex_ids = [t for t in cat_toid if isinstance(t, str)]
+    nex_toid = []
+    for nex in nex_ids:
+        i = int(nex[4:])
+        down = rng.integers(i + 1, n) if i + 1 < n and rng.random() > 0.2 else None
+        nex_toid.append(f"wb-{down}" if down is not None else np.nan)
+    divides = pd.DataFrame({"id": cats, "toid": cat_toid})
+    nexus = pd.DataFrame({"id": nex_ids, "toid": nex_toid})
+    return divides, nexus
+
+
+def test_index_matches_traversal():
+    for seed in range(5):
+        divides, nexus = random_network(300, seed)
+        topology = Topology(divides, nexus)
+        index = UpstreamIndex.from_topology(topology)
+        for catchment_id in divides["id"]:
+            assert index.upstream(catchment_id) == topology.upstream(catchment_id)
+
+
+def test_index_with_null_toid():
+    divides = pd.DataFrame(
+        {"id": ["cat-1", "cat-2", "cat-3"], "toid": [np.nan, np.nan, "nex-2"]}
+    )
+    nexus = pd.DataFrame({"id": ["nex-2"], "toid": ["wb-1"]})
+    topology = Topology(divides, nexus)
+    index = UpstreamIndex.from_topology(topology)
+    for catchment_id in divides["id"]:
+        assert index.upstream(catchment_id) == topology.upstream(catchment_id)
+    assert index.upstream("cat-1") == ({"cat-1", "cat-3"}, {"nex-2"})
@@ -9,25 +9,105 @@ Author: Karnesh Jain
 
 """
 
+import hashlib
+import itertools
+import json
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
 import xarray as xr
 import fsspec
+from fsspec.implementations.reference import LazyReferenceMapper
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from kerchunk.hdf import SingleHdf5ToZarr
 from kerchunk.combine import MultiZarrToZarr
 
 
+# Default location of the single file reference cache
+REFERENCE_CACHE_DIR = os.environ.get(
+    'NWM_REFERENCE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'nwm_references')
+)
+
+
+class ReferenceCache:
+    """
+    Local directory of single file kerchunk references.
+
+    NWM output files are immutable once published, so the references of a file
+    are stored under a key made of its path and object generation (or etag) and
+    only regenerated if the object is republished.
+    """
+
+    def __init__(self, directory=REFERENCE_CACHE_DIR):
+        """
+        Instantiate ReferenceCache class
+
+        Parameters
+        ----------
+        directory : str, default: REFERENCE_CACHE_DIR
+            Directory the references are stored in
+        """
+        self.directory = directory
+
+    def path(self, path, info):
+        """
+        Location of the cached references of a file
+
+        Parameters
+        ----------
+        path: str
+            Path of the file on its filesystem
+        info: dict
+            Filesystem info of the file
+
+        Returns
+        -------
+        str
+        """
+        version = (info.get('generation') or info.get('etag') or info.get('ETag')
+                   or f"{info.get('size')}-{info.get('mtime') or info.get('updated')}")
+        key = hashlib.sha256(f'{path}:{version}'.encode()).hexdigest()
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, path, info):
+        """
+        Cached references of a file, None if it has not been scanned before
+        """
+        try:
+            with open(self.path(path, info)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, path, info, references):
+        """
+        Store the references of a file
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        target = self.path(path, info)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(references, f)
+        os.replace(tmp, target)
+
+
 class NWMData:
     """
     The NWMData class provides methods for querying NWM data on Google Cloud Platform.
     """
 
-    def __init__(self, bucket_name='national-water-model'):
+    def __init__(self, bucket_name='national-water-model', cache_dir=REFERENCE_CACHE_DIR):
         """
         Instantiate NWMData class
 
         Parameters
         ----------
         bucket_name : str, default: 'national-water-model' (Google Cloud Bucket)
+        cache_dir : str, default: REFERENCE_CACHE_DIR
+            Directory single file references are cached in, None to always scan files
 
         Returns
         -------
@@ -36,6 +116,7 @@ class NWMData:
 
         # set bucket_name
         self.bucket_name = bucket_name
+        self.cache = ReferenceCache(cache_dir) if cache_dir else None
 
     def daterange(self, start_date, end_date):
         """
@@ -57,7 +138,8 @@ class NWMData:
             yield cur_date
             cur_date += timedelta(days=1)
 
-    def get_dataset(self, start_date, end_date, configuration):
+    def get_dataset(self, start_date, end_date, configuration, max_workers=16, retries=3,
+                    parquet_path=None, feature_ids=None, variables=None):
         """
         Method to get the NWM dataset
 
@@ -69,6 +151,17 @@ class NWMData:
             End date for getting the NWM data
         configuration: str
             Particular model simulation or forecast configuration
+        max_workers: int, default: 16
+            Number of files scanned concurrently
+        retries: int, default: 3
+            Number of times a failed file scan is retried
+        parquet_path: str, optional
+            Write the combined references to this directory in Parquet reference format
+            and open them lazily, instead of holding them in memory
+        feature_ids: list (int), optional
+            Only fetch and return these features, see get_features
+        variables: list (str), optional
+            Only return these variables, all variables by default
 
         Returns
         -------
@@ -76,6 +169,46 @@ class NWMData:
             The dataset containing NWM data for queried configuration from start to end date.
         """
 
+        if parquet_path is not None:
+            self.write_parquet_references(start_date, end_date, configuration, parquet_path,
+                                          max_workers=max_workers, retries=retries)
+            combined_dataset = parquet_path
+        else:
+            combined_dataset = self.get_references(start_date, end_date, configuration,
+                                                   max_workers=max_workers, retries=retries)
+
+        if feature_ids is not None:
+            return self.get_features(combined_dataset, feature_ids, variables)
+
+        ds = self.open_dataset(combined_dataset)
+        if variables is not None:
+            ds = ds[variables]
+
+        return ds
+
+    def get_references(self, start_date, end_date, configuration, max_workers=16, retries=3):
+        """
+        Method to get the combined kerchunk references of the NWM dataset
+
+        Parameters
+        ----------
+        start_date: str, YYYYMMDD format
+            Start date for getting the NWM data
+        end_date: str, YYYYMMDD format
+            End date for getting the NWM data
+        configuration: str
+            Particular model simulation or forecast configuration
+        max_workers: int, default: 16
+            Number of files scanned concurrently
+        retries: int, default: 3
+            Number of times a failed file scan is retried
+
+        Returns
+        -------
+        references: dict
+            Combined references of the files of the configuration from start to end date
+        """
+
         # Validate configuration
         if configuration not in self.configurations:
             message = f'Invalid configuration. Must select from {str(self.configurations)}'
@@ -83,21 +216,258 @@ class NWMData:
 
         files = self.get_files(start_date, end_date, configuration)
 
-        open_files = fsspec.open_files(files)
-        out_zarr = []
-        for file in open_files:
-            with file as f:
-                out_zarr.append(SingleHdf5ToZarr(f, file.path).translate())
+        out_zarr = self.scan_files(files, max_workers=max_workers, retries=retries)
+
+        return self.combine_references(out_zarr)
+
+    def write_parquet_references(self, start_date, end_date, configuration, path,
+                                 record_size=100000, max_workers=16, retries=3):
+        """
+        Write the combined references of the NWM dataset in Parquet reference format
+
+        The combined references are written in batches of record_size chunk references
+        instead of being built up as one dict, and open_dataset(path) only loads the
+        batches that are accessed.
+
+        Parameters
+        ----------
+        start_date: str, YYYYMMDD format
+            Start date for getting the NWM data
+        end_date: str, YYYYMMDD format
+            End date for getting the NWM data
+        configuration: str
+            Particular model simulation or forecast configuration
+        path: str
+            Directory to write the references to, replaced if it exists
+        record_size: int, default: 100000
+            Number of chunk references per Parquet file
+        max_workers: int, default: 16
+            Number of files scanned concurrently
+        retries: int, default: 3
+            Number of times a failed file scan is retried
+        """
+
+        if configuration not in self.configurations:
+            message = f'Invalid configuration. Must select from {str(self.configurations)}'
+            raise ValueError(message)
+
+        files = self.get_files(start_date, end_date, configuration)
+
+        out_zarr = self.scan_files(files, max_workers=max_workers, retries=retries)
+
+        # the Parquet mapper needs a variable's .zarray before any of its chunks
+        out_zarr = [self._metadata_first(refs) for refs in out_zarr]
+
+        fs, root = fsspec.core.url_to_fs(path)
+        if fs.exists(root):
+            fs.rm(root, recursive=True)
+        out = LazyReferenceMapper.create(root, fs=fs, record_size=record_size)
 
         mzz = MultiZarrToZarr(out_zarr,
+                              remote_protocol='gcs',
+                              concat_dims=['time', 'reference_time'],
+                              out=out,
+                              )
+
+        mzz.translate()
+        out.flush()
+
+    @staticmethod
+    def _metadata_first(references):
+        """
+        Single file references with the zarr metadata keys ahead of the chunk keys
+
+        MultiZarrToZarr copies the variables that are identical across files in the
+        order of their references, and LazyReferenceMapper cannot store a chunk of a
+        variable whose .zarray it has not seen yet.
+
+        Parameters
+        ----------
+        references: dict
+            Kerchunk references of a file
+
+        Returns
+        -------
+        references: dict
+            The same references, reordered
+        """
+
+        refs = references.get('refs', references)
+        refs = dict(sorted(refs.items(),
+                           key=lambda item: not item[0].rsplit('/', 1)[-1].startswith('.z')))
+        if 'refs' in references:
+            return {**references, 'refs': refs}
+        return refs
+
+    def append_references(self, references, start_date, end_date, configuration, path=None,
+                          max_workers=16, retries=3):
+        """
+        Add newly published files to existing combined references
+
+        Only files of the date range that are not already part of the references are
+        scanned, files that are not published yet are skipped, and the new files are
+        combined with the existing references along time/reference_time instead of
+        recombining every file.
+
+        Parameters
+        ----------
+        references: dict or str
+            Combined references from get_references or append_references, or the path
+            of a file written by write_references
+        start_date: str, YYYYMMDD format
+            Start date of the files to add
+        end_date: str, YYYYMMDD format
+            End date of the files to add
+        configuration: str
+            Particular model simulation or forecast configuration
+        path: str, optional
+            Where to write the updated references, by default the file references was
+            read from if it is a path
+        max_workers: int, default: 16
+            Number of files scanned concurrently
+        retries: int, default: 3
+            Number of times a failed file scan is retried
+
+        Returns
+        -------
+        references: dict
+            The updated combined references
+        """
+
+        if configuration not in self.configurations:
+            message = f'Invalid configuration. Must select from {str(self.configurations)}'
+            raise ValueError(message)
+
+        if not isinstance(references, dict):
+            path = path or references
+            references = self.read_references(references)
+
+        known = self.reference_files(references)
+        files = [file for file in self.get_files(start_date, end_date, configuration)
+                 if fsspec.core.split_protocol(file)[1] not in known]
+        scanned = self.scan_files(files, max_workers=max_workers, retries=retries,
+                                  skip_missing=True)
+        new = [(file, refs) for file, refs in zip(files, scanned) if refs is not None]
+
+        if new:
+            added = self.combine_references([refs for _, refs in new])
+            mzz = MultiZarrToZarr([references, added],
+                                  remote_protocol='gcs',
+                                  concat_dims=['time', 'reference_time'],
+                                  )
+            references = mzz.translate()
+
+        if path is not None:
+            self.write_references(references, path)
+
+        return references
+
+    def combine_references(self, references):
+        """
+        Combine single file references along time/reference_time
+
+        Parameters
+        ----------
+        references: list (dict)
+            Kerchunk references of each file
+
+        Returns
+        -------
+        references: dict
+            Combined references
+        """
+
+        mzz = MultiZarrToZarr(references,
                               remote_protocol='gcs',
                               concat_dims=['time', 'reference_time'],
                               )
 
         combined_dataset = mzz.translate()
 
+        return combined_dataset
+
+    @staticmethod
+    def reference_files(references):
+        """
+        Files that combined references point to
+
+        The chunk references already name the file each chunk comes from, so the files
+        references were built from need not be stored alongside them.
+
+        Parameters
+        ----------
+        references: dict
+            Combined references
+
+        Returns
+        -------
+        files: set (str)
+            Referenced files, without protocol
+        """
+
+        # [url] or [url, offset, length]; inlined data and zarr metadata are strings
+        urls = {ref[0] for ref in references.get('refs', references).values()
+                if isinstance(ref, list) and ref and ref[0]}
+        templates = references.get('templates') or {}
+        files = set()
+        for url in urls:
+            for name, value in templates.items():
+                url = url.replace('{{' + name + '}}', value)
+            files.add(fsspec.core.split_protocol(url)[1])
+        return files
+
+    def write_references(self, references, path):
+        """
+        Write combined references to a JSON file, replacing it atomically
+
+        Parameters
+        ----------
+        references: dict
+            Combined references
+        path: str
+            JSON file to write
+        """
+
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.part')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(references, f)
+        os.replace(tmp, path)
+
+    def read_references(self, path):
+        """
+        Read combined references written by write_references
+
+        Parameters
+        ----------
+        path: str
+            JSON file to read
+
+        Returns
+        -------
+        references: dict
+        """
+
+        with open(path) as f:
+            return json.load(f)
+
+    def open_dataset(self, references):
+        """
+        Open combined references as a dataset
+
+        Parameters
+        ----------
+        references: dict or str
+            Combined references, or the path of a file written by write_references or of
+            a directory written by write_parquet_references
+
+        Returns
+        -------
+        ds: xarray.Dataset
+        """
+
         backend_args = {"consolidated": False,
-                        "storage_options": {"fo": combined_dataset,
+                        "storage_options": {"fo": references,
                                             "remote_protocol": "gcs",
                                             "remote_options": {'anon': True}}}
 
@@ -108,6 +478,205 @@ class NWMData:
 
         return ds
 
+    def get_features(self, references, feature_ids, variables=None, max_gap=2**16,
+                     max_block=2**26):
+        """
+        Load the data of a few features from combined references
+
+        Only the chunks holding the requested features are fetched. Their byte ranges
+        are planned up front from the references, ranges of the same file less than
+        max_gap bytes apart are merged into a single request, and the requests are
+        issued together rather than one chunk at a time.
+
+        Parameters
+        ----------
+        references: dict or str
+            Combined references, as accepted by open_dataset
+        feature_ids: list (int)
+            Features to load, in the order they are returned
+        variables: list (str), optional
+            Variables to load, by default every variable along feature_id
+        max_gap: int, default: 64 KiB
+            Largest gap between two chunks of a file fetched in the same request
+        max_block: int, default: 64 MiB
+            Largest merged request
+
+        Returns
+        -------
+        ds: xarray.Dataset
+            The requested variables and features, loaded in memory
+        """
+
+        refs = self._reference_mapping(references)
+        arrays = {key[:-len('/.zarray')]
+                  for key in getattr(refs, 'zmetadata', refs) if key.endswith('/.zarray')}
+        dims = {name: json.loads(refs[f'{name}/.zattrs'])['_ARRAY_DIMENSIONS'] for name in arrays}
+        coords = [name for name in arrays if dims[name] == [name]]
+        if variables is None:
+            variables = sorted(name for name in arrays
+                               if 'feature_id' in dims[name] and name not in coords)
+
+        all_features = pd.Index(self.open_dataset(references)['feature_id'].values)
+        positions = all_features.get_indexer(feature_ids)
+        if (positions < 0).any():
+            missing = np.asarray(feature_ids)[positions < 0]
+            raise KeyError(f'feature_ids not in the dataset: {missing.tolist()}')
+
+        subset = {key: refs[key] for key in ('.zgroup', '.zattrs') if key in refs}
+        ranges = []
+        for name in set(coords) | set(variables):
+            for meta in ('.zarray', '.zattrs'):
+                subset[f'{name}/{meta}'] = refs[f'{name}/{meta}']
+            zarray = json.loads(refs[f'{name}/.zarray'])
+            chunk_ranges = [range(-(-size // chunk)) for size, chunk
+                            in zip(zarray['shape'], zarray['chunks'])]
+            if name in variables and 'feature_id' in dims[name]:
+                axis = dims[name].index('feature_id')
+                chunk_ranges[axis] = np.unique(positions // zarray['chunks'][axis]).tolist()
+            separator = zarray.get('dimension_separator') or '.'
+            for index in itertools.product(*chunk_ranges):
+                key = f'{name}/' + (separator.join(map(str, index)) if index else '0')
+                try:
+                    ref = refs[key]
+                except KeyError:
+                    continue  # missing chunks are fill values
+                if name in variables and isinstance(ref, list) and len(ref) == 3:
+                    ranges.append((ref[0], ref[1], ref[1] + ref[2], key))
+                else:
+                    subset[key] = ref
+
+        fs = fsspec.filesystem('gcs', anon=True)
+        requests = self._merge_ranges(ranges, max_gap, max_block)
+        blocks = fs.cat_ranges([url for url, _, _, _ in requests],
+                               [start for _, start, _, _ in requests],
+                               [end for _, _, end, _ in requests])
+        for (_, start, _, chunks), block in zip(requests, blocks):
+            for chunk_start, chunk_end, key in chunks:
+                subset[key] = block[chunk_start - start:chunk_end - start]
+
+        ds = self.open_dataset({'version': 1, 'refs': subset})
+        return ds[variables].isel(feature_id=positions).load()
+
+    def _reference_mapping(self, references):
+        """
+        Chunk key to reference mapping of combined references as accepted by open_dataset
+        """
+
+        if isinstance(references, dict):
+            return references.get('refs', references)
+        fs, root = fsspec.core.url_to_fs(references)
+        if fs.isdir(root):
+            return LazyReferenceMapper(root, fs=fs)
+        return self.read_references(references)['refs']
+
+    @staticmethod
+    def _merge_ranges(ranges, max_gap, max_block):
+        """
+        Merge byte ranges of the same file that are at most max_gap bytes apart
+
+        Parameters
+        ----------
+        ranges: list (tuple)
+            (url, start, end, key) of each chunk
+        max_gap: int
+            Largest gap between two ranges merged together
+        max_block: int
+            Largest merged range
+
+        Returns
+        -------
+        requests: list (tuple)
+            (url, start, end, [(start, end, key) of each chunk in the range])
+        """
+
+        requests = []
+        for url, start, end, key in sorted(ranges):
+            if requests:
+                last_url, last_start, last_end, chunks = requests[-1]
+                if (url == last_url and start - last_end <= max_gap
+                        and max(end, last_end) - last_start <= max_block):
+                    requests[-1] = (url, last_start, max(end, last_end), chunks)
+                    chunks.append((start, end, key))
+                    continue
+            requests.append((url, start, end, [(start, end, key)]))
+        return requests
+
+    def scan_files(self, files, max_workers=16, retries=3, skip_missing=False):
+        """
+        Generate the kerchunk references of many files concurrently
+
+        Scanning a file is dominated by small remote metadata reads, so the
+        files are scanned on a pool of threads.
+
+        Parameters
+        ----------
+        files: list (str)
+            Files to scan, as returned by get_files
+        max_workers: int, default: 16
+            Number of files scanned concurrently
+        retries: int, default: 3
+            Number of times a failed file scan is retried
+        skip_missing: bool, default: False
+            Return None for files that do not exist instead of raising FileNotFoundError
+
+        Returns
+        -------
+        references: list (dict)
+            Kerchunk references of each file, in the order of files
+        """
+
+        def scan(file):
+            try:
+                return self.scan_file(file, retries)
+            except FileNotFoundError:
+                if not skip_missing:
+                    raise
+                return None
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(scan, files))
+
+    def scan_file(self, file, retries=3, backoff=1.0):
+        """
+        Generate the kerchunk references of a file, retrying failed scans
+
+        The reference cache is consulted first, so each published file is only
+        scanned once.
+
+        Parameters
+        ----------
+        file: str
+            File to scan
+        retries: int, default: 3
+            Number of times a failed scan is retried
+        backoff: float, default: 1.0
+            Seconds to wait before the first retry, doubled for each retry after
+
+        Returns
+        -------
+        references: dict
+            Kerchunk references of the file, from the cache if it has been scanned before
+        """
+        for attempt in range(retries + 1):
+            try:
+                open_file = fsspec.open(file)
+                if self.cache is not None:
+                    info = open_file.fs.info(open_file.path)
+                    references = self.cache.get(open_file.path, info)
+                    if references is not None:
+                        return references
+                with open_file as f:
+                    references = SingleHdf5ToZarr(f, open_file.path).translate()
+                if self.cache is not None:
+                    self.cache.put(open_file.path, info, references)
+                return references
+            except FileNotFoundError:
+                raise
+            except Exception:
+                if attempt == retries:
+                    raise
+                time.sleep(backoff * 2 ** attempt)
+
     def get_files(self, start_date, end_date, configuration):
         """
 
@@ -134,15 +703,15 @@ class NWMData:
 
         for date in self.daterange(start, end):
             date_str = date.strftime('%Y%m%d')
-            for time in self.configurations[configuration]['t']:
+            for t in self.configurations[configuration]['t']:
                 if 'analysis' in configuration:
                     for tm in self.configurations[configuration]['tm']:
-                        files.append(f'gcs://{self.bucket_name}/nwm.{date_str}/{configuration}/nwm.t{time:02d}z.'
+                        files.append(f'gcs://{self.bucket_name}/nwm.{date_str}/{configuration}/nwm.t{t:02d}z.'
                                      f'{self.configurations[configuration]["fname_config"]}.{self.configurations[configuration]["var"]}.tm{tm:02d}.'
                                      f'conus.nc')
                 else:
                     for f in self.configurations[configuration]['f']:
-                        files.append(f'gcs://{self.bucket_name}/nwm.{date_str}/{configuration}/nwm.t{time:02d}z.'
+                        files.append(f'gcs://{self.bucket_name}/nwm.{date_str}/{configuration}/nwm.t{t:02d}z.'
                                      f'{self.configurations[configuration]["fname_config"]}.{self.configurations[configuration]["var"]}.f{f:03d}.'
                                      f'conus.nc')
 
@@ -0,0 +1,64 @@
+"""Checks of the Parquet references against the in-memory combine"""
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+pytest.importorskip("h5netcdf")
+pytest.importorskip("fastparquet")
+
+from gcp import NWMData
+
+
+def nwm_files(directory, n=3, features=2000):
+    # channel_rt like files: one time step each and a shared feature_id large
+    # enough not to be inlined in the references
+    files = []
+    rng = np.random.default_rng(0)
+    for i in range(n):
+        t = pd.Timestamp("2023-01-01") + pd.Timedelta(hours=i)
+        ds = xr.Dataset(
+            {"streamflow": (("time", "feature_id"), rng.random((1, features), "f4"))},
+            coords={
+                "time": [t],
+                "reference_time": [t],
+                "feature_id": np.arange(features, dtype="i4"),
+            },
+        )
+        file = str(directory / f"nwm.t{i:02d}z.analysis_assim.channel_rt.tm00.conus.nc")
+        units = {"units": "minutes since 1970-01-01 00:00:00"}
+        ds.to_netcdf(
+            file,
+            engine="h5netcdf",
+            encoding={"time": units, "reference_time": units},
+        )
+        files.append(file)
+    return files
+
+
+def open_references(references):
+    return xr.open_dataset(
+        "reference://",
+        engine="zarr",
+        backend_kwargs={
+            "consolidated": False,
+            "storage_options": {"fo": references, "remote_protocol": "file"},
+        },
+    )
+
+
+def test_write_parquet_references(tmp_path, monkeypatch):
+    files = nwm_files(tmp_path)
+    nwm = NWMData(cache_dir=None)
+    monkeypatch.setattr(nwm, "get_files", lambda *args: files)
+
+    path = str(tmp_path / "refs")
+    nwm.write_parquet_references(
+        "20230101", "20230101", "analysis_assim", path, record_size=100
+    )
+    combined = nwm.combine_references(nwm.scan_files(files))
+
+    with open_references(path) as written, open_references(combined) as expected:
+        xr.testing.assert_identical(written.load(), expected.load())
+        assert written.sizes == {"time": 3, "reference_time": 3, "feature_id": 2000}
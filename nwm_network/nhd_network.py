@@ -1,8 +1,16 @@
+import gc
+import hashlib
+import os
+import shutil
+import tempfile
 from collections import defaultdict, Counter, deque
 from itertools import chain
 from functools import reduce, partial
-from collections.abc import Iterable
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 from toolz import pluck
+import numpy as np
 
 
 def reverse_dict(d):
@@ -51,6 +59,30 @@ def extract_connections(rows, target_col, terminal_codes=None):
     return network
 
 
+def extract_network(rows, target_col, terminal_codes=None):
+    '''
+    Extract downstream and upstream connection networks from dataframe
+    in one pass over the columns. Array-backed counterpart of
+    `extract_connections` followed by `reverse_network`.
+
+    Arguments:
+    ----------
+    rows      (DataFrame): Dataframe indexed by key_col.
+    target_col      (str): Target of edge
+    terminal_codes (iterable): Target codes indicating no downstream segment
+
+    Returns:
+    --------
+    connections (Network): {segment id: [list of downstream adjacent segment ids]}
+    rconn       (Network): {segment id: [list of upstream adjacent segment ids]}
+    
+    '''
+    connections = Network.from_columns(
+        rows.index.values, rows[target_col].values, terminal_codes
+    )
+    return connections, connections.reverse()
+
+
 def extract_waterbody_connections(rows, target_col = 'waterbody', waterbody_null=-9999):
     '''
     Extract waterbody mapping from parameter dataframe. Mapping segment ids to the lake ids they reside in
@@ -119,6 +151,9 @@ def reverse_network(N):
     rg (dict, int: [int]): upstream network connections
     
     '''
+    if isinstance(N, Network):
+        return N.reverse()
+
     rg = defaultdict(list)
     for src, dst in N.items():
         rg[src]
@@ -128,6 +163,283 @@ def reverse_network(N):
     return rg
 
 
+def _position_dtype(n):
+    return np.int32 if n < np.iinfo(np.int32).max else np.int64
+
+
+class Network(Mapping):
+    '''
+    Array-backed network connections graph in compressed sparse row (CSR) form.
+
+    Segments are addressed by position. `ids` maps position -> segment id and
+    the adjacency of the segment at position i is
+    `ids[indices[offsets[i]:offsets[i + 1]]]`. Positions [0, n_keys) are the
+    segments that have an adjacency row (the keys of the equivalent dict);
+    any remaining positions are segments that only appear as connection
+    targets.
+
+    A Network behaves as a read-only {segment id: [adjacent segment ids]}
+    mapping, so it can be handed to the dict-based functions of this module
+    in place of the output of `extract_connections` or `reverse_network`.
+
+    Arguments:
+    ----------
+    ids     (array-like, int): Segment id of each position, keys first
+    offsets (array-like, int): Row offsets into indices, length n_keys + 1
+    indices (array-like, int): Adjacent segment positions
+    sorter  (array-like, int): Positions in id order, if already known
+    '''
+
+    # arrays that fully describe a Network, see `_from_arrays`
+    _arrays = ("ids", "offsets", "indices", "_sorter", "_sorted_ids")
+
+    def __init__(self, ids, offsets, indices, sorter=None):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=_position_dtype(len(self.ids)))
+        self.n_keys = len(self.offsets) - 1
+
+        # id -> position index, kept as a sorted copy of ids for searchsorted
+        if sorter is None:
+            sorter = np.argsort(self.ids, kind="stable")
+        self._sorter = np.asarray(sorter, dtype=np.int64)
+        self._sorted_ids = self.ids[self._sorter]
+
+    @classmethod
+    def _from_arrays(cls, arrays):
+        # rebuild from already indexed arrays (e.g. shared or memory-mapped)
+        # without copying or re-sorting them
+        network = cls.__new__(cls)
+        for name in cls._arrays:
+            setattr(network, name, arrays[name])
+        network.n_keys = len(network.offsets) - 1
+        return network
+
+    @classmethod
+    def _from_adjacency(cls, keys, counts, targets, key_sorter=None):
+        # targets are grouped by key, in key order; targets that are not keys
+        # are appended after the keys. key_sorter orders keys by id, if the
+        # caller already has it
+        if key_sorter is None:
+            key_sorter = np.argsort(keys, kind="stable")
+        sorted_keys = keys[key_sorter]
+        # look targets up in id order, sorted needles keep searchsorted
+        # walking forward through sorted_keys instead of jumping around
+        target_sorter = np.argsort(targets, kind="stable")
+        i = np.empty(len(targets), dtype=np.int64)
+        i[target_sorter] = np.searchsorted(sorted_keys, targets[target_sorter])
+        i[i == len(keys)] = 0
+        is_key = sorted_keys[i] == targets
+        dangling, dangling_index = np.unique(targets[~is_key], return_inverse=True)
+
+        positions = np.empty(len(targets), dtype=np.int64)
+        positions[is_key] = key_sorter[i[is_key]]
+        positions[~is_key] = len(keys) + dangling_index
+
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        # merge the two sorted runs, keys and dangling, into the id order
+        # of the whole network instead of sorting the ids again
+        sorter = np.empty(len(keys) + len(dangling), dtype=np.int64)
+        sorter[np.arange(len(keys)) + np.searchsorted(dangling, sorted_keys)] = key_sorter
+        sorter[np.arange(len(dangling)) + np.searchsorted(sorted_keys, dangling)] = (
+            len(keys) + np.arange(len(dangling))
+        )
+
+        return cls(np.concatenate([keys, dangling]), offsets, positions, sorter)
+
+    @classmethod
+    def from_connections(cls, N):
+        '''
+        Build a Network from a connections dictionary.
+
+        Arguments:
+        ----------
+        N (dict, int: [int]): Network connections graph
+
+        Returns:
+        --------
+        (Network): array-backed copy of N
+        '''
+        keys = np.fromiter(N.keys(), dtype=np.int64, count=len(N))
+        counts = np.fromiter(map(len, N.values()), dtype=np.int64, count=len(N))
+        targets = np.fromiter(
+            chain.from_iterable(N.values()), dtype=np.int64, count=int(counts.sum())
+        )
+        return cls._from_adjacency(keys, counts, targets)
+
+    @classmethod
+    def from_columns(cls, sources, targets, terminal_codes=None):
+        '''
+        Build a Network directly from edge columns, e.g. the RouteLink
+        `link` and `to` arrays. Equivalent to `extract_connections` but
+        grouped with a single stable sort instead of a Python loop.
+
+        Arguments:
+        ----------
+        sources        (array-like, int): Source of each edge
+        targets        (array-like, int): Target of each edge
+        terminal_codes (iterable): Target codes that mark a source without
+                                   downstream connections (default: {0})
+
+        Returns:
+        --------
+        (Network): network connections, keys ordered by first appearance
+        '''
+        if terminal_codes is None:
+            terminal_codes = [0]
+        sources = np.asarray(sources, dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+
+        # group rows by source; the stable sort keeps the first row of
+        # each group at the group start
+        row_sorter = np.argsort(sources, kind="stable")
+        sorted_sources = sources[row_sorter]
+        group_start = np.empty(len(sources), dtype=bool)
+        group_start[:1] = True
+        np.not_equal(sorted_sources[1:], sorted_sources[:-1], out=group_start[1:])
+        first = row_sorter[group_start]
+
+        # key position of every group, keys in order of first appearance;
+        # rank also orders the keys by id, since groups are sorted by id
+        key_order = np.argsort(first, kind="stable")
+        rank = np.empty_like(key_order)
+        rank[key_order] = np.arange(len(key_order))
+        group = np.cumsum(group_start) - 1
+
+        # edges stay grouped by source in row_sorter order, with rows in
+        # original order within a group; place each group at its key's row
+        edges = ~np.isin(targets, np.fromiter(terminal_codes, dtype=np.int64))
+        sorted_edges = edges[row_sorter]
+        edge_group = group[sorted_edges]
+        group_counts = np.bincount(edge_group, minlength=len(first))
+        counts = group_counts[key_order]
+        offsets = np.zeros(len(first) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        group_offsets = np.zeros(len(first), dtype=np.int64)
+        np.cumsum(group_counts[:-1], out=group_offsets[1:])
+        slot = (
+            offsets[rank[edge_group]]
+            + np.arange(len(edge_group))
+            - group_offsets[edge_group]
+        )
+        edge_targets = np.empty(len(edge_group), dtype=np.int64)
+        edge_targets[slot] = targets[row_sorter[sorted_edges]]
+
+        return cls._from_adjacency(
+            sorted_sources[group_start][key_order], counts, edge_targets, rank
+        )
+
+    def positions(self, segments):
+        '''
+        Translate segment ids to positions.
+
+        Arguments:
+        ----------
+        segments (array-like, int): Segment ids
+
+        Returns:
+        --------
+        (ndarray, int): Positions of segments. Raises KeyError on unknown ids.
+        '''
+        segments = np.asarray(segments, dtype=np.int64)
+        i = np.searchsorted(self._sorted_ids, segments)
+        i[i == len(self._sorted_ids)] = 0
+        found = self._sorted_ids[i] == segments
+        if not found.all():
+            raise KeyError(segments[~found].tolist())
+        return self._sorter[i]
+
+    def _position(self, key):
+        i = np.searchsorted(self._sorted_ids, key)
+        if i < len(self._sorted_ids) and self._sorted_ids[i] == key:
+            p = self._sorter[i]
+            if p < self.n_keys:
+                return p
+        return None
+
+    def in_degrees(self):
+        '''
+        (ndarray, int): number of connections into each position
+        '''
+        return np.bincount(self.indices, minlength=len(self.ids))
+
+    def out_degrees(self):
+        '''
+        (ndarray, int): number of connections out of each position
+        '''
+        degrees = np.zeros(len(self.ids), dtype=np.int64)
+        degrees[: self.n_keys] = np.diff(self.offsets)
+        return degrees
+
+    def successors(self, positions):
+        '''
+        Gather the adjacency rows of many positions at once.
+
+        Arguments:
+        ----------
+        positions (ndarray, int): Key positions
+
+        Returns:
+        --------
+        (ndarray, int): Concatenated adjacent positions, in row order
+        '''
+        starts = self.offsets[positions]
+        counts = self.offsets[positions + 1] - starts
+        shift = np.repeat(starts - np.cumsum(counts) + counts, counts)
+        return self.indices[shift + np.arange(len(shift))]
+
+    def reverse(self):
+        '''
+        Reverse network connections graph. Every segment is a key of the
+        reversed network, matching `reverse_network`.
+
+        Returns:
+        --------
+        (Network): upstream network connections
+        '''
+        n = len(self.ids)
+        sources = np.repeat(
+            np.arange(self.n_keys, dtype=self.indices.dtype), np.diff(self.offsets)
+        )
+        order = np.argsort(self.indices, kind="stable")
+
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(self.in_degrees(), out=offsets[1:])
+
+        return Network(self.ids, offsets, sources[order], self._sorter)
+
+    def to_dict(self):
+        '''
+        (dict, int: [int]): dictionary copy of the network
+        '''
+        targets = self.ids[self.indices].tolist()
+        offsets = self.offsets.tolist()
+        return {
+            k: targets[offsets[i] : offsets[i + 1]]
+            for i, k in enumerate(self.ids[: self.n_keys].tolist())
+        }
+
+    def __getitem__(self, key):
+        p = self._position(key)
+        if p is None:
+            raise KeyError(key)
+        return self.ids[self.indices[self.offsets[p] : self.offsets[p + 1]]].tolist()
+
+    def __contains__(self, key):
+        return self._position(key) is not None
+
+    def __iter__(self):
+        return iter(self.ids[: self.n_keys].tolist())
+
+    def __len__(self):
+        return self.n_keys
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.n_keys} segments, {len(self.indices)} connections)"
+
+
 def find_tw_for_node(reaches_bytw, node):
     # TODO: extend this function (or write a new one) to handle a list of nodes.
     # Such functionality might be useful for finding networks corresponding to a
@@ -170,6 +482,9 @@ def headwaters(N):
       will return network tailwaters.
       
     '''
+    if isinstance(N, Network):
+        hw = N.in_degrees()[: N.n_keys] == 0
+        return set(N.ids[: N.n_keys][hw].tolist())
     return N.keys() - chain.from_iterable(N.values())
 
 def tailwaters(N):
@@ -190,6 +505,8 @@ def tailwaters(N):
       will return network headwaters.
       
     '''
+    if isinstance(N, Network):
+        return set(N.ids[N.out_degrees() == 0].tolist())
     tw = chain.from_iterable(N.values()) - N.keys()
     for m, n in N.items():
         if not n:
@@ -240,6 +557,64 @@ def reachable(N, sources=None, targets=None):
     return rv
 
 
+def reachable_labels(N, sources=None, targets=None):
+    """
+    Label segments with the nearest source they are reachable from.
+
+    All searches advance together, one breadth-first level per step, and a
+    segment is claimed by the first search to reach it. Each source
+    therefore stops at other sources, so nested sources (e.g. gages upstream
+    of gages) partition the network instead of overlapping as in `reachable`.
+
+    Arguments:
+    ----------
+    N (dict, int: [int] or Network): Reverse network connections
+    sources (iterable): Segments from which to start searches. 
+                        If none, network tailwaters are used
+    targets (iterable): Target segments to stop searching.
+
+    Returns:
+    segments (ndarray, int): Segments reachable from any source
+    labels   (ndarray, int): Source each segment in segments was reached from
+    
+    """
+    if not isinstance(N, Network):
+        N = Network.from_connections(N)
+
+    if sources is None:
+        sources = headwaters(N)
+    sources = np.fromiter(sources, dtype=np.int64)
+
+    owner = _reachable_owner(N, N.positions(sources), targets)
+    reached = np.flatnonzero(owner >= 0)
+    return N.ids[reached], sources[owner[reached]]
+
+
+def _reachable_owner(N, frontier, targets=None):
+    # index into frontier of the search that claimed each position of N,
+    # -1 for positions no search reached
+    owner = np.full(len(N.ids), -1, dtype=np.int64)
+    owner[frontier] = np.arange(len(frontier))
+    if targets is None:
+        expandable = np.ones(len(N.ids), dtype=bool)
+    else:
+        expandable = ~np.isin(N.ids, np.fromiter(targets, dtype=np.int64))
+    expandable[N.n_keys :] = False
+
+    while frontier.size:
+        frontier = frontier[expandable[frontier]]
+        counts = N.offsets[frontier + 1] - N.offsets[frontier]
+        children = N.successors(frontier)
+        child_owner = np.repeat(owner[frontier], counts)
+
+        unclaimed = owner[children] == -1
+        children, first = np.unique(children[unclaimed], return_index=True)
+        owner[children] = child_owner[unclaimed][first]
+        frontier = children
+
+    return owner
+
+
 def reachable_network(N, sources=None, targets=None, check_disjoint=True):
     """
     Return subnetworks generated by reach
@@ -555,6 +930,110 @@ def dfs_decomposition(N, path_func, source_nodes=None):
     return paths
 
 
+def dfs_decomposition_arrays(
+    N, gage_nodes=None, waterbody_nodes=None, source_nodes=None
+):
+    """
+    Array-based counterpart of `dfs_decomposition`. Decomposes the network
+    into reaches that break at junctions and, optionally, at gages and
+    waterbody inlets/outlets, matching `split_at_junction`,
+    `split_at_gages_and_junctions`, `split_at_waterbodies_and_junctions`
+    and `split_at_gages_waterbodies_and_junctions`.
+
+    Break points are evaluated once for every segment as boolean masks and
+    reaches are assembled by following segment -> downstream links for all
+    reaches at the same time. Reaches are ordered by topological level of
+    the reach graph, so for any reach the predecessor reaches appear before
+    it. Assumes a dendritic network (one downstream segment per segment).
+
+    Arguments:
+    ----------
+    N (dict {int: [int]} or Network): Reverse network connections
+    gage_nodes         (iterable): Segments with gages
+    waterbody_nodes    (iterable): Segments within waterbodies
+    source_nodes       (iterable): Segments from which to begin reach creation.
+                                   defaults to network tailwater.
+
+    Returns:
+    --------
+    offsets (ndarray, int): Reach offsets into segments, length n_reaches + 1
+    segments (ndarray, int): Segment ids of each reach, upstream to downstream
+    
+    """
+    if not isinstance(N, Network):
+        N = Network.from_connections(N)
+    n = len(N.ids)
+
+    # stay in positions from here on, source_nodes is only read once
+    if source_nodes is None:
+        sources = np.flatnonzero(N.in_degrees()[: N.n_keys] == 0)
+    else:
+        sources = N.positions(np.fromiter(source_nodes, dtype=np.int64))
+    in_net = _reachable_owner(N, sources) >= 0
+    in_net[N.n_keys :] = False
+    if not in_net.any():
+        return np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int64)
+    is_source = np.zeros(n, dtype=bool)
+    is_source[sources] = True
+
+    # downstream position of every segment (first parent in N)
+    parents = np.repeat(np.arange(N.n_keys), np.diff(N.offsets))
+    children, first = np.unique(N.indices, return_index=True)
+    down = np.full(n, -1, dtype=np.int64)
+    down[children] = parents[first]
+
+    # a segment continues into its downstream segment unless that is a break
+    has_down = in_net & ~is_source & (down >= 0)
+    x = np.flatnonzero(has_down)
+    d = down[x]
+    joined = N.out_degrees()[d] == 1
+    if gage_nodes is not None:
+        gage = np.isin(N.ids, np.fromiter(gage_nodes, dtype=np.int64))
+        joined &= ~gage[x] & ~gage[d]
+    if waterbody_nodes is not None:
+        wbody = np.isin(N.ids, np.fromiter(waterbody_nodes, dtype=np.int64))
+        joined &= wbody[x] == wbody[d]
+    nxt = np.full(n, -1, dtype=np.int64)
+    nxt[x[joined]] = d[joined]
+
+    # walk all reaches downstream from their upstream-most segment at once
+    is_head = in_net.copy()
+    is_head[nxt[nxt >= 0]] = False
+    heads = np.flatnonzero(is_head)
+    reach_of = np.full(n, -1, dtype=np.int64)
+    rank = np.zeros(n, dtype=np.int64)
+    tail = heads.copy()
+    frontier = heads
+    reach = np.arange(len(heads))
+    step = 0
+    while frontier.size:
+        reach_of[frontier] = reach
+        rank[frontier] = step
+        tail[reach] = frontier
+        more = nxt[frontier] >= 0
+        frontier = nxt[frontier[more]]
+        reach = reach[more]
+        step += 1
+
+    # order reaches so that upstream reaches come first
+    down_tail = down[tail]
+    down_reach = np.where(down_tail >= 0, reach_of[np.maximum(down_tail, 0)], -1)
+    reach_ids = np.arange(len(heads))
+    levels = kahn_toposort_levels(
+        Network.from_columns(reach_ids, down_reach, terminal_codes=[-1])
+    )
+    reach_order = np.empty(len(heads), dtype=np.int64)
+    reach_order[np.concatenate(levels)] = reach_ids
+
+    members = np.flatnonzero(reach_of >= 0)
+    members = members[np.lexsort((rank[members], reach_order[reach_of[members]]))]
+    offsets = np.zeros(len(heads) + 1, dtype=np.int64)
+    reach_sizes = np.bincount(reach_order[reach_of[members]], minlength=len(heads))
+    np.cumsum(reach_sizes, out=offsets[1:])
+
+    return offsets, N.ids[members]
+
+
 def segment_deps(segments, connections):
     """Build a dependency graph of segments
 
@@ -577,6 +1056,26 @@ def segment_deps(segments, connections):
     return dict(deps)
 
 
+def in_degrees(N):
+    '''
+    Count the connections into each segment of a network
+    
+    Arguments
+    ---------
+    N (dict, int: [int]): Network connections graph
+    
+    Returns
+    -------
+    degs (Counter, int: int): {segment id: number of connections into segment}
+    
+    '''
+    if isinstance(N, Network):
+        return Counter(dict(zip(N.ids.tolist(), N.in_degrees().tolist())))
+    degs = Counter(chain.from_iterable(N.values()))
+    degs.update(dict.fromkeys(headwaters(N), 0))
+    return degs
+
+
 def kahn_toposort(N):
     degrees = in_degrees(N)
     zero_degree = set(k for k, v in degrees.items() if v == 0)
@@ -599,6 +1098,46 @@ def kahn_toposort(N):
         pass
 
 
+def kahn_toposort_levels(N):
+    '''
+    Partition a network into topological levels (wavefronts).
+    
+    Level 0 holds the segments without inflow and every other segment
+    sits one level below the deepest segment flowing into it. Segments
+    within a level are independent of each other, so each level can be
+    processed as a batch once the preceding levels are done.
+    
+    Arguments
+    ---------
+    N (dict, int: [int] or Network): Network connections graph
+    
+    Returns
+    -------
+    levels (list of ndarray): segment ids of each level, in level order
+    
+    '''
+    if not isinstance(N, Network):
+        N = Network.from_connections(N)
+
+    degrees = N.in_degrees()
+    frontier = np.flatnonzero(degrees == 0)
+    levels = []
+    n_sorted = 0
+    while frontier.size:
+        levels.append(N.ids[frontier])
+        n_sorted += frontier.size
+
+        # decrement in-degrees of everything fed by the current level
+        children = N.successors(frontier[frontier < N.n_keys])
+        children, counts = np.unique(children, return_counts=True)
+        degrees[children] -= counts
+        frontier = children[degrees[children] == 0]
+
+    if n_sorted < len(N.ids):
+        raise Exception("Cycle exists!")
+    return levels
+
+
 def kahn_toposort_edges(N):
     sorted_nodes = kahn_toposort(N)
     for n in sorted_nodes:
@@ -654,8 +1193,9 @@ def replace_waterbodies_connections(connections, waterbodies):
     """
     new_conn = {}
     link_lake = {}
-    waterbody_nets = separate_waterbodies(connections, waterbodies)
-    rconn = reverse_network(connections)
+
+    # group segments by waterbody once, {lake id: [segments in lake]}
+    lake_nodes = reverse_surjective_mapping(waterbodies)
 
     for n in connections:
         if n in waterbodies:
@@ -664,11 +1204,15 @@ def replace_waterbodies_connections(connections, waterbodies):
                 continue
 
             # get all nodes from waterbody
-            wbody_nodes = [k for k, v in waterbodies.items() if v == wbody_code]
+            wbody_nodes = lake_nodes[wbody_code]
             outgoing = reservoir_shore(connections, wbody_nodes)
             new_conn[wbody_code] = outgoing
             
-            link_lake[wbody_code] = list(set(rconn[outgoing[0]]).intersection(set(wbody_nodes)))[0]
+            # waterbody segment(s) draining to the first outgoing segment
+            outlet = outgoing[0]
+            link_lake[wbody_code] = list(
+                {k for k in wbody_nodes if outlet in connections[k]}
+            )[0]
 
         elif reservoir_boundary(connections, waterbodies, n):
             # one of the children of n is a member of a waterbody
@@ -686,7 +1230,156 @@ def replace_waterbodies_connections(connections, waterbodies):
     
     return new_conn, link_lake
 
-def build_subnetworks(connections, rconn, min_size, sources=None):
+def _share_network(N):
+    """
+    Copy the arrays of a Network into shared memory blocks.
+
+    Returns the blocks (to be closed and unlinked by the caller) and a
+    picklable spec from which `_attach_network` rebuilds the Network.
+    """
+    blocks = []
+    spec = {}
+    for name in Network._arrays:
+        a = getattr(N, name)
+        shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+        np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[:] = a
+        blocks.append(shm)
+        spec[name] = (shm.name, a.dtype.str, a.shape)
+    return blocks, spec
+
+
+def _attach_network(spec):
+    blocks = []
+    arrays = {}
+    for name, (shm_name, dtype, shape) in spec.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        blocks.append(shm)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    return blocks, Network._from_arrays(arrays)
+
+
+# per-process state of the build_subnetworks* worker pools
+_worker_args = ()
+
+
+def _init_network_worker(specs, args):
+    # the per-source searches are dict lookups on single keys, which are much
+    # faster on a dict than on a Network, so copy each shared network into a
+    # dict once per worker and release the shared memory. Objects inherited
+    # from a forked parent are frozen so the collector does not walk (and
+    # copy) the parent's heap while the dicts are built.
+    global _worker_args
+    gc.freeze()
+    networks = []
+    for spec in specs:
+        blocks, N = _attach_network(spec)
+        networks.append(N.to_dict())
+        del N
+        for shm in blocks:
+            shm.close()
+    _worker_args = (*networks, *args)
+
+
+def _run_network_worker(func, net):
+    return func(net, *_worker_args)
+
+
+def _map_tailwater_networks(func, sources, networks, args, n_workers):
+    """
+    Apply func(net, *networks, *args) to every source with a process pool.
+
+    The networks are converted to Networks and shared with the workers
+    through shared memory instead of being pickled for every task; each
+    worker copies them into dicts once. Results are returned in the order
+    of sources.
+    """
+    networks = [
+        N if isinstance(N, Network) else Network.from_connections(N)
+        for N in networks
+    ]
+    sources = list(sources)
+    shared = [_share_network(N) for N in networks]
+    try:
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            initializer=_init_network_worker,
+            initargs=([spec for _, spec in shared], args),
+        ) as executor:
+            return list(
+                executor.map(
+                    partial(_run_network_worker, func),
+                    sources,
+                    chunksize=max(1, len(sources) // (4 * n_workers)),
+                )
+            )
+    finally:
+        for blocks, _ in shared:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+
+def _build_subnetworks_from(net, connections, rconn, min_size, all_hws):
+
+    # subnetwork creation using a breadth first search restricted by maximum allowable depth
+    # new_sources_list = [net]
+    new_sources = set([net])
+    subnetworks = {}
+    group_order = 0
+    while new_sources:
+
+        # Build dict object containing reachable nodes within max_depth from each source in new_sources
+        rv = {}
+        for h in new_sources:
+
+            reachable = set()
+            Q = deque([(h, 0)])
+            stop_depth = 1000000
+            while Q:
+
+                x, y = Q.popleft()
+                reachable.add(x)
+
+                rx = rconn.get(x, ())
+                if len(rx) > 1:
+                    us_depth = y + 1
+                else:
+                    us_depth = y
+
+                if len(reachable) > min_size:
+                    stop_depth = y
+
+                if us_depth <= stop_depth:
+                    Q.extend(zip(rx, [us_depth] * len(rx)))
+
+            # reachable: a list of reachable segments within max_depth from source node h
+            rv[h] = reachable
+
+        # find headwater segments in reachable groups, these will become the next set of sources
+        # new_sources_list = []
+        new_sources = set()
+        for tw, seg in rv.items():
+            # identify downstream connections for segments in this subnetwork
+            c = {key: connections[key] for key in seg}
+            # find apparent headwaters, will include new sources and actual headwaters
+            sub_hws = headwaters(c)
+            # extract new sources by differencing with list of actual headwaters
+            srcs = sub_hws - all_hws
+            # append list of new sources
+            new_sources.update(srcs)
+            # remove new sources from the subnetwork list
+            rv[tw].difference_update(srcs)
+
+        # append master dictionary
+        subnetworks[group_order] = rv
+
+        # advance group order
+        group_order += 1
+
+    return subnetworks
+
+
+def build_subnetworks(connections, rconn, min_size, sources=None, n_workers=None):
     """
     Construct subnetworks using a truncated breadth-first-search
 
@@ -695,6 +1388,8 @@ def build_subnetworks(connections, rconn, min_size, sources=None):
         rconn
         max_depth
         sources
+        n_workers (int): number of processes across which independent tailwater
+                         networks are distributed. Default (None) runs serially.
     Returns:
         subnetwork_master
     """
@@ -706,70 +1401,134 @@ def build_subnetworks(connections, rconn, min_size, sources=None):
     # create a list of all headwaters in the network
     all_hws = headwaters(connections)
 
+    if n_workers is not None and n_workers > 1:
+        sources = list(sources)
+        results = _map_tailwater_networks(
+            _build_subnetworks_from,
+            sources,
+            (connections, rconn),
+            (min_size, all_hws),
+            n_workers,
+        )
+        return dict(zip(sources, results))
+
     subnetwork_master = {}
     for net in sources:
+        subnetwork_master[net] = _build_subnetworks_from(
+            net, connections, rconn, min_size, all_hws
+        )
 
-        # subnetwork creation using a breadth first search restricted by maximum allowable depth
-        # new_sources_list = [net]
-        new_sources = set([net])
-        subnetworks = {}
-        group_order = 0
-        while new_sources:
-
-            # Build dict object containing reachable nodes within max_depth from each source in new_sources
-            rv = {}
-            for h in new_sources:
+    return subnetwork_master
 
-                reachable = set()
-                Q = deque([(h, 0)])
-                stop_depth = 1000000
-                while Q:
 
-                    x, y = Q.popleft()
-                    reachable.add(x)
+def _build_subnetworks_btw_reservoirs_from(
+    net, rconn, all_wbodies, gage_conns, targets
+):
+    new_sources = set([net])
+    subnetworks = {}
+    group_order = 0
+    subnetworks[group_order] = {}
+    reached_wbodies_hold = set()
 
-                    rx = rconn.get(x, ())
-                    if len(rx) > 1:
-                        us_depth = y + 1
-                    else:
-                        us_depth = y
-
-                    if len(reachable) > min_size:
-                        stop_depth = y
-
-                    if us_depth <= stop_depth:
-                        Q.extend(zip(rx, [us_depth] * len(rx)))
-
-                # reachable: a list of reachable segments within max_depth from source node h
-                rv[h] = reachable
-
-            # find headwater segments in reachable groups, these will become the next set of sources
-            # new_sources_list = []
-            new_sources = set()
-            for tw, seg in rv.items():
-                # identify downstream connections for segments in this subnetwork
-                c = {key: connections[key] for key in seg}
-                # find apparent headwaters, will include new sources and actual headwaters
-                sub_hws = headwaters(c)
-                # extract new sources by differencing with list of actual headwaters
-                srcs = sub_hws - all_hws
-                # append list of new sources
-                new_sources.update(srcs)
-                # remove new sources from the subnetwork list
-                rv[tw].difference_update(srcs)
-
-            # append master dictionary
-            subnetworks[group_order] = rv
-
-            # advance group order
-            group_order += 1
+    while new_sources:
 
-        subnetwork_master[net] = subnetworks
+        rv = {}
+        reached_wbodies = set()
+        reached_gage_conn = set()
+        for h in new_sources:
+            
+            reached_segs = set()
+            Q = deque([h])
+            while Q:
+                x = Q.popleft()
+                
+                if x not in set.union(all_wbodies, gage_conns):
+                    reached_segs.add(x)
+                    
+                elif x in all_wbodies:
+                    reached_wbodies.add(x)
+                    
+                else:
+                    reached_gage_conn.add(x)
+                    reached_segs.add(x)
 
-    return subnetwork_master
+                if x not in targets:
+                    Q.extend(rconn.get(x, ()))
+
+            rv[h] = reached_segs
+
+        # append master dictionary
+        subnetworks[group_order].update(rv) # stream network
+        
+        # reset sources
+        new_sources = set()
+        
+        # in the event that both gages and water bodies are found in the previous search itteration
+        # (group_order - 1), add water bodies to group_order include reservoir inflows as new sources
+        # for the next search itteration
+        if reached_wbodies_hold:
+            res_dict = {}
+            for s in reached_wbodies_hold:
+                res_dict[s] = {s}
+                new_sources.update(rconn[s])
+                
+            subnetworks[group_order].update(res_dict) # reservoirs
+            reached_wbodies_hold = set()
+            
+        # search itteration finds gages (and maybe reservoirs, but maybe not)
+        if reached_gage_conn:
+            
+            # start next search itteration from found gages
+            for w in reached_gage_conn:
+                new_sources.update(rconn[w])
+            
+            # hold onto list of reached water bodies
+            if reached_wbodies:
+                reached_wbodies_hold = reached_wbodies
+            
+            # remove reached gages from search target set
+            targets = targets.difference(reached_gage_conn)
+            
+            # remove reached gages from all_gages set
+            gage_conns = gage_conns.difference(reached_gage_conn)
+            
+            # advance group order by 1 and initialize order dictionary
+            group_order += 1
+            subnetworks[group_order] = {}
+            
+        # search itteration finds only water bodies
+        elif not reached_gage_conn and reached_wbodies:
+            
+            # start next search itteration from inflows to found reservoirs
+            for w in reached_wbodies:
+                new_sources.update(rconn[w])
+                
+            # add found reservoirs to next order
+            res_dict = {}
+            for s in reached_wbodies:
+                res_dict[s] = {s}
+            subnetworks[group_order + 1] = res_dict # reservoirs
+            
+            # advance order by 2 to hop over the order containing only reservoirs
+            group_order += 2
+            subnetworks[group_order] = {}
+        
+        else:
+            
+            group_order += 1
+            if new_sources:
+                subnetworks[group_order] = {}
+            
+#             # if new sources contains gages, remove those gages from target and all_gages sets
+#             if new_sources.intersection(all_gages):
+#                 a = new_sources.intersection(all_gages)
+#                 targets = targets.difference(a)
+#                 all_gages = all_gages.difference(a)
+            
+    return subnetworks
 
 
-def build_subnetworks_btw_reservoirs(connections, rconn, wbodies, all_gages, independent_networks, sources=None):
+def build_subnetworks_btw_reservoirs(connections, rconn, wbodies, all_gages, independent_networks, sources=None, n_workers=None):
     """
     Isolate subnetworks between reservoirs using a breadth-first-search
     Arguments:
@@ -779,6 +1538,8 @@ def build_subnetworks_btw_reservoirs(connections, rconn, wbodies, all_gages, ind
         all_gages (set): list of segments containing stream gages
         sources (set): list of segments from which to begin breadth-first searches. Default to
                        network tailwaters
+        n_workers (int): number of processes across which independent tailwater networks
+                         are distributed. Default (None) runs serially.
     Returns:
         subnetwork_master (dict): {[subnetwork order]: 
                                       {[subnetwork tail water]: 
@@ -798,110 +1559,24 @@ def build_subnetworks_btw_reservoirs(connections, rconn, wbodies, all_gages, ind
     # search targets are all headwaters or water bodies that are not also sources
     targets = {x for x in set.union(all_hws, all_wbodies, gage_conns) if x not in sources}
 
-    networks_with_subnetworks_ordered = {}
-    for net in sources:
-        new_sources = set([net])
-        subnetworks = {}
-        group_order = 0
-        subnetworks[group_order] = {}
-        reached_wbodies_hold = set()
-
-        while new_sources:
-
-            rv = {}
-            reached_wbodies = set()
-            reached_gage_conn = set()
-            for h in new_sources:
-                
-                reached_segs = set()
-                Q = deque([h])
-                while Q:
-                    x = Q.popleft()
-                    
-                    if x not in set.union(all_wbodies, gage_conns):
-                        reached_segs.add(x)
-                        
-                    elif x in all_wbodies:
-                        reached_wbodies.add(x)
-                        
-                    else:
-                        reached_gage_conn.add(x)
-                        reached_segs.add(x)
-
-                    if x not in targets:
-                        Q.extend(rconn.get(x, ()))
-
-                rv[h] = reached_segs
-
-            # append master dictionary
-            subnetworks[group_order].update(rv) # stream network
-            
-            # reset sources
-            new_sources = set()
-            
-            # in the event that both gages and water bodies are found in the previous search itteration
-            # (group_order - 1), add water bodies to group_order include reservoir inflows as new sources
-            # for the next search itteration
-            if reached_wbodies_hold:
-                res_dict = {}
-                for s in reached_wbodies_hold:
-                    res_dict[s] = {s}
-                    new_sources.update(rconn[s])
-                    
-                subnetworks[group_order].update(res_dict) # reservoirs
-                reached_wbodies_hold = set()
-                
-            # search itteration finds gages (and maybe reservoirs, but maybe not)
-            if reached_gage_conn:
-                
-                # start next search itteration from found gages
-                for w in reached_gage_conn:
-                    new_sources.update(rconn[w])
-                
-                # hold onto list of reached water bodies
-                if reached_wbodies:
-                    reached_wbodies_hold = reached_wbodies
-                
-                # remove reached gages from search target set
-                targets = targets.difference(reached_gage_conn)
-                
-                # remove reached gages from all_gages set
-                gage_conns = gage_conns.difference(reached_gage_conn)
-                
-                # advance group order by 1 and initialize order dictionary
-                group_order += 1
-                subnetworks[group_order] = {}
-                
-            # search itteration finds only water bodies
-            elif not reached_gage_conn and reached_wbodies:
-                
-                # start next search itteration from inflows to found reservoirs
-                for w in reached_wbodies:
-                    new_sources.update(rconn[w])
-                    
-                # add found reservoirs to next order
-                res_dict = {}
-                for s in reached_wbodies:
-                    res_dict[s] = {s}
-                subnetworks[group_order + 1] = res_dict # reservoirs
-                
-                # advance order by 2 to hop over the order containing only reservoirs
-                group_order += 2
-                subnetworks[group_order] = {}
-            
-            else:
-                
-                group_order += 1
-                if new_sources:
-                    subnetworks[group_order] = {}
-                
-#             # if new sources contains gages, remove those gages from target and all_gages sets
-#             if new_sources.intersection(all_gages):
-#                 a = new_sources.intersection(all_gages)
-#                 targets = targets.difference(a)
-#                 all_gages = all_gages.difference(a)
-                
-        networks_with_subnetworks_ordered[net] = subnetworks
+    if n_workers is not None and n_workers > 1:
+        sources = list(sources)
+        results = _map_tailwater_networks(
+            _build_subnetworks_btw_reservoirs_from,
+            sources,
+            (rconn,),
+            (all_wbodies, gage_conns, targets),
+            n_workers,
+        )
+        networks_with_subnetworks_ordered = dict(zip(sources, results))
+    else:
+        networks_with_subnetworks_ordered = {}
+        for net in sources:
+            networks_with_subnetworks_ordered[net] = (
+                _build_subnetworks_btw_reservoirs_from(
+                    net, rconn, all_wbodies, gage_conns, targets
+                )
+            )
 
     # create a dictionary of ordered subnetworks
     subnetwork_master = defaultdict(dict)
@@ -925,3 +1600,329 @@ def build_subnetworks_btw_reservoirs(connections, rconn, wbodies, all_gages, ind
             ] = dfs_decomposition(rconn_subn, path_func)
             
     return reaches_ordered_bysubntw, subnetworks, subnetwork_master
+
+
+class DynamicNetwork:
+    '''
+    Network connections that can be edited in place while keeping derived
+    structures current.
+
+    Keeps downstream and upstream connections, headwater and tailwater
+    sets, the topological level of every segment (as in
+    `kahn_toposort_levels`) and the reach decomposition (as in
+    `dfs_decomposition_arrays`). An edge edit only revisits the segments
+    downstream of the edit whose level changes and the reaches touching
+    the edited segments. Assumes a dendritic network.
+
+    Arguments:
+    ----------
+    connections (dict, int: [int] or Network): downstream network connections
+    gage_nodes      (iterable): Segments with gages, used as reach breaks
+    waterbody_nodes (iterable): Segments within waterbodies, used as reach breaks
+    '''
+
+    def __init__(self, connections, gage_nodes=None, waterbody_nodes=None):
+        if isinstance(connections, Network):
+            connections = connections.to_dict()
+        self.connections = {k: list(v) for k, v in connections.items()}
+        for n in chain.from_iterable(connections.values()):
+            self.connections.setdefault(n, [])
+        self.rconn = reverse_network(self.connections)
+        self.gage_nodes = set(gage_nodes or ())
+        self.waterbody_nodes = set(waterbody_nodes or ())
+
+        self.headwaters = {k for k, v in self.rconn.items() if not v}
+        self.tailwaters = {k for k, v in self.connections.items() if not v}
+
+        self.level = {}
+        for i, l in enumerate(kahn_toposort_levels(self.connections)):
+            self.level.update(dict.fromkeys(l.tolist(), i))
+
+        # reaches keyed by their upstream-most segment
+        self.reaches = {}
+        self.reach_of = {}
+        offsets, segments = dfs_decomposition_arrays(
+            self.rconn,
+            self.gage_nodes or None,
+            self.waterbody_nodes or None,
+        )
+        offsets = offsets.tolist()
+        segments = segments.tolist()
+        for i in range(len(offsets) - 1):
+            reach = segments[offsets[i] : offsets[i + 1]]
+            self.reaches[reach[0]] = reach
+            self.reach_of.update(dict.fromkeys(reach, reach[0]))
+
+    def add_edge(self, src, dst):
+        '''
+        Connect segment src to downstream segment dst. Unknown segments are
+        added to the network.
+        '''
+        for n in (src, dst):
+            if n not in self.connections:
+                self.connections[n] = []
+                self.rconn[n] = []
+                self.headwaters.add(n)
+                self.tailwaters.add(n)
+                self.level[n] = 0
+        if dst in self.connections[src]:
+            return
+        if src == dst or src in self._downstream(dst):
+            raise Exception("Cycle exists!")
+
+        self.connections[src].append(dst)
+        self.rconn[dst].append(src)
+        self.tailwaters.discard(src)
+        self.headwaters.discard(dst)
+        self._update(src, dst)
+
+    def remove_edge(self, src, dst):
+        '''
+        Disconnect segment src from downstream segment dst.
+        '''
+        self.connections[src].remove(dst)
+        self.rconn[dst].remove(src)
+        if not self.connections[src]:
+            self.tailwaters.add(src)
+        if not self.rconn[dst]:
+            self.headwaters.add(dst)
+        self._update(src, dst)
+
+    def redirect(self, segment, to=None):
+        '''
+        Re-point the downstream connection of segment to `to`, or make it a
+        tailwater if `to` is None.
+        '''
+        if to in self.connections and segment in self._downstream(to):
+            raise Exception("Cycle exists!")
+        for dst in list(self.connections.get(segment, ())):
+            self.remove_edge(segment, dst)
+        if to is not None:
+            self.add_edge(segment, to)
+
+    def topological_levels(self):
+        '''
+        (list of ndarray): segment ids of each level, as kahn_toposort_levels
+        '''
+        return [np.array(l, dtype=np.int64) for l in self._by_level(self.level)]
+
+    def reach_decomposition(self):
+        '''
+        (list): reaches ordered so that predecessor reaches come first
+        '''
+        heads = {h: self.level[h] for h in self.reaches}
+        return [self.reaches[h] for l in self._by_level(heads) for h in l]
+
+    @staticmethod
+    def _by_level(level):
+        by_level = defaultdict(list)
+        for n, l in level.items():
+            by_level[l].append(n)
+        return [sorted(by_level[l]) for l in sorted(by_level)]
+
+    def _downstream(self, n):
+        seen = set()
+        Q = deque([n])
+        while Q:
+            x = Q.popleft()
+            if x not in seen:
+                seen.add(x)
+                Q.extend(self.connections[x])
+        return seen
+
+    def _update(self, src, dst):
+        # levels can only change at dst and downstream of it
+        Q = deque([dst])
+        while Q:
+            x = Q.popleft()
+            level = max((self.level[u] + 1 for u in self.rconn[x]), default=0)
+            if level != self.level[x]:
+                self.level[x] = level
+                Q.extend(self.connections[x])
+
+        # only src and the segments flowing into dst change whether they
+        # continue into their downstream segment
+        self._rebuild_reaches([src, dst, *self.rconn[dst]])
+
+    def _joins(self, n):
+        # downstream segment n continues into within a reach, or None
+        down = self.connections[n]
+        if not down:
+            return None
+        d = down[0]
+        if len(self.rconn[d]) != 1:
+            return None
+        if n in self.gage_nodes or d in self.gage_nodes:
+            return None
+        if (n in self.waterbody_nodes) != (d in self.waterbody_nodes):
+            return None
+        return d
+
+    def _rebuild_reaches(self, segments):
+        nodes = set()
+        for n in segments:
+            head = self.reach_of.get(n)
+            nodes.update(self.reaches.pop(head, (n,)))
+        for n in nodes:
+            self.reach_of.pop(n, None)
+
+        joins = {n: self._joins(n) for n in nodes}
+        for head in nodes.difference(joins.values()):
+            reach = [head]
+            while joins.get(reach[-1]) is not None:
+                reach.append(joins[reach[-1]])
+            self.reaches[head] = reach
+            self.reach_of.update(dict.fromkeys(reach, head))
+
+
+def routelink_cache_key(routelink, blocksize=2**24):
+    '''
+    Hash the contents of a RouteLink file for use as a network cache key.
+    
+    Arguments
+    ---------
+    routelink (str or Path): RouteLink file the network is built from
+    blocksize        (int): read size in bytes
+    
+    Returns
+    -------
+    (str): hex digest of the file contents
+    
+    '''
+    h = hashlib.sha256()
+    with open(routelink, "rb") as f:
+        for block in iter(partial(f.read, blocksize), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def write_network_cache(
+    cache_path, connections, rconn=None, reaches=None, levels=None, link_lake=None
+):
+    '''
+    Write prebuilt network structures to a cache directory of .npy files
+    that `read_network_cache` opens as memory maps. The arrays are written
+    to a new versioned directory next to cache_path, and cache_path is a
+    symlink swapped onto it with `os.replace` when complete, so concurrent
+    readers never see a partial or missing cache. Concurrent writers of the
+    same cache each swap in a complete version and the last one wins.
+    
+    Arguments
+    ---------
+    cache_path (str or Path): cache directory, e.g.
+                              os.path.join(cache_dir, routelink_cache_key(routelink))
+    connections (dict or Network): downstream network connections
+    rconn       (dict or Network): upstream network connections
+    reaches  (tuple of ndarray): (offsets, segments) from dfs_decomposition_arrays
+    levels (list of ndarray): topological levels from kahn_toposort_levels
+    link_lake  (dict, int: int): waterbody crosswalk from replace_waterbodies_connections
+    
+    '''
+    cache_path = os.fspath(cache_path)
+    arrays = {}
+    for prefix, N in (("connections", connections), ("rconn", rconn)):
+        if N is None:
+            continue
+        if not isinstance(N, Network):
+            N = Network.from_connections(N)
+        for name in Network._arrays:
+            arrays[f"{prefix}_{name.lstrip('_')}"] = getattr(N, name)
+    if reaches is not None:
+        arrays["reaches_offsets"], arrays["reaches_segments"] = reaches
+    if levels is not None:
+        arrays["levels_offsets"] = np.concatenate(
+            [[0], np.cumsum([len(l) for l in levels], dtype=np.int64)]
+        )
+        arrays["levels_segments"] = (
+            np.concatenate(levels) if levels else np.zeros(0, dtype=np.int64)
+        )
+    if link_lake is not None:
+        arrays["link_lake_lakes"] = np.fromiter(link_lake.keys(), dtype=np.int64)
+        arrays["link_lake_segments"] = np.fromiter(link_lake.values(), dtype=np.int64)
+
+    parent = os.path.dirname(os.path.abspath(cache_path))
+    os.makedirs(parent, exist_ok=True)
+    version = tempfile.mkdtemp(prefix=os.path.basename(cache_path) + ".", dir=parent)
+    link = version + ".link"
+    previous = None
+    try:
+        for name, a in arrays.items():
+            np.save(os.path.join(version, name + ".npy"), np.asarray(a))
+        os.symlink(os.path.basename(version), link)
+        if os.path.islink(cache_path):
+            previous = os.path.realpath(cache_path)
+        try:
+            os.replace(link, cache_path)
+        except OSError:
+            if not os.path.isdir(cache_path):
+                raise
+            # a plain cache directory is in place, leave it to its readers
+            previous = version
+            os.unlink(link)
+    except BaseException:
+        shutil.rmtree(version, ignore_errors=True)
+        if os.path.lexists(link):
+            os.unlink(link)
+        raise
+    if previous is not None:
+        # readers that already opened the old version keep their memory maps
+        shutil.rmtree(previous, ignore_errors=True)
+
+
+def read_network_cache(cache_path):
+    '''
+    Open a network cache written by `write_network_cache`. Arrays are
+    memory-mapped read-only, so processes opening the same cache share
+    its pages through the OS page cache.
+    
+    Arguments
+    ---------
+    cache_path (str or Path): cache directory
+    
+    Returns
+    -------
+    (dict): the cached structures under the keyword names of
+            `write_network_cache`, or None if there is no cache at cache_path
+    
+    '''
+    cache_path = os.fspath(cache_path)
+    for retry in (False, True):
+        # resolve the link once, so all arrays come from the same version
+        version = os.path.realpath(cache_path)
+        if not os.path.isdir(version):
+            return None
+        try:
+            arrays = {
+                name[: -len(".npy")]: np.load(
+                    os.path.join(version, name), mmap_mode="r"
+                )
+                for name in os.listdir(version)
+                if name.endswith(".npy")
+            }
+            break
+        except FileNotFoundError:
+            # a concurrent write replaced the version while it was opened
+            if retry:
+                raise
+
+    cached = {}
+    for prefix in ("connections", "rconn"):
+        if f"{prefix}_ids" in arrays:
+            cached[prefix] = Network._from_arrays(
+                {
+                    name: arrays[f"{prefix}_{name.lstrip('_')}"]
+                    for name in Network._arrays
+                }
+            )
+    if "reaches_offsets" in arrays:
+        cached["reaches"] = (arrays["reaches_offsets"], arrays["reaches_segments"])
+    if "levels_offsets" in arrays:
+        offsets = arrays["levels_offsets"]
+        cached["levels"] = [
+            arrays["levels_segments"][offsets[i] : offsets[i + 1]]
+            for i in range(len(offsets) - 1)
+        ]
+    if "link_lake_lakes" in arrays:
+        lakes = arrays["link_lake_lakes"].tolist()
+        cached["link_lake"] = dict(zip(lakes, arrays["link_lake_segments"].tolist()))
+    return cached
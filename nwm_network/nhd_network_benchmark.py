@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+"""nhd_network_benchmark.py
+Time and peak memory benchmarks for the nhd_network graph algorithms on
+synthetic dendritic river networks, so performance can be tracked without
+downloading a RouteLink file.
+
+Example:
+
+    python nhd_network_benchmark.py --sizes 10000 100000 1000000 --branching 3
+"""
+
+import gc
+import time
+import tracemalloc
+from collections import deque
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+import nhd_network as nhd
+
+
+def synthetic_routelink(
+    n_segments,
+    branching=2,
+    reach_length=5,
+    waterbody_density=0.01,
+    gage_density=0.005,
+    n_tailwaters=1,
+    seed=0,
+):
+    """
+    Generate a synthetic dendritic river network in RouteLink form.
+
+    Segments are laid out in reaches of geometrically distributed length.
+    Each reach drains into the upstream end of its parent reach and every
+    reach receives `branching` upstream reaches, giving junctions of
+    `branching` inflows. Waterbodies cover whole reaches and gages sit on
+    segments outside waterbodies.
+
+    Arguments
+    ---------
+    n_segments          (int): number of stream segments
+    branching           (int): upstream reaches per junction
+    reach_length      (float): mean number of segments between junctions
+    waterbody_density (float): fraction of reaches inside a waterbody
+    gage_density      (float): fraction of segments with a gage
+    n_tailwaters        (int): number of independent networks
+    seed                (int): random seed
+
+    Returns
+    -------
+    (DataFrame): indexed by segment id with columns `to` (0 at tailwaters),
+                 `waterbody` (-9999 outside waterbodies) and `gages`
+                 (byte strings, blank where there is no gage)
+    """
+    rng = np.random.default_rng(seed)
+
+    lengths = rng.geometric(1 / reach_length, size=int(n_segments / reach_length) + 1)
+    while lengths.sum() < n_segments:
+        more = rng.geometric(1 / reach_length, size=len(lengths))
+        lengths = np.concatenate([lengths, more])
+    ends = np.cumsum(lengths)
+    n_reaches = int(np.searchsorted(ends, n_segments)) + 1
+    lengths = lengths[:n_reaches]
+    lengths[-1] -= ends[n_reaches - 1] - n_segments
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    reach = np.repeat(np.arange(n_reaches), lengths)
+
+    # parent reach of every reach; the first n_tailwaters reaches drain out
+    parent = np.full(n_reaches, -1)
+    parent[n_tailwaters:] = np.arange(n_reaches - n_tailwaters) // branching
+
+    # positions run upstream to downstream within a reach
+    to = np.arange(1, n_segments + 1)
+    tails = starts + lengths - 1
+    to[tails] = np.where(parent >= 0, starts[np.maximum(parent, 0)], -1)
+
+    ids = rng.permutation(n_segments) + 1
+    to = np.where(to >= 0, ids[np.minimum(to, n_segments - 1)], 0)
+
+    lake_reach = rng.random(n_reaches) < waterbody_density
+    lake_reach[parent < 0] = False  # waterbodies need an outlet
+    lake_ids = n_segments + 1 + np.cumsum(lake_reach) - 1
+    waterbody = np.where(lake_reach[reach], lake_ids[reach], -9999)
+
+    gaged = rng.random(n_segments) < gage_density
+    gaged &= (waterbody == -9999) & (to != 0)
+    gages = np.full(n_segments, b" " * 15, dtype="S15")
+    gages[gaged] = [b"%015d" % i for i in np.flatnonzero(gaged)]
+
+    return pd.DataFrame(
+        {"to": to, "waterbody": waterbody, "gages": gages},
+        index=pd.Index(ids, name="link"),
+    )
+
+
+def _consume(it):
+    deque(it, maxlen=0)
+
+
+def benchmark_cases(routelink, n_workers=4):
+    """
+    Prepare inputs and return the benchmark cases for a network.
+
+    Arguments
+    ---------
+    routelink (DataFrame): as returned by synthetic_routelink
+    n_workers       (int): processes for the *_workers cases
+
+    Returns
+    -------
+    (list): (name, callable) pairs
+    """
+    connections = nhd.extract_connections(routelink, "to")
+    rconn = nhd.reverse_network(connections)
+    network, rnetwork = nhd.extract_network(routelink, "to")
+    wbodies = nhd.extract_waterbody_connections(routelink)
+    gages = set(nhd.gage_mapping(routelink)["gages"])
+
+    wb_conn, _ = nhd.replace_waterbodies_connections(connections, wbodies)
+    wb_rconn = nhd.reverse_network(wb_conn)
+    independent_networks = nhd.reachable_network(wb_rconn)
+    junctions = partial(nhd.split_at_junction, rconn)
+
+    return [
+        ("extract_connections", lambda: nhd.extract_connections(routelink, "to")),
+        ("extract_network", lambda: nhd.extract_network(routelink, "to")),
+        ("reverse_network", lambda: nhd.reverse_network(connections)),
+        ("reachable", lambda: nhd.reachable(rconn)),
+        ("reachable_labels", lambda: nhd.reachable_labels(rnetwork)),
+        ("dfs_decomposition", lambda: nhd.dfs_decomposition(rconn, junctions)),
+        ("dfs_decomposition_arrays", lambda: nhd.dfs_decomposition_arrays(rnetwork)),
+        ("kahn_toposort", lambda: _consume(nhd.kahn_toposort(connections))),
+        ("kahn_toposort_levels", lambda: nhd.kahn_toposort_levels(network)),
+        (
+            "replace_waterbodies_connections",
+            lambda: nhd.replace_waterbodies_connections(connections, wbodies),
+        ),
+        ("build_subnetworks", lambda: nhd.build_subnetworks(connections, rconn, 500)),
+        (
+            "build_subnetworks_workers",
+            lambda: nhd.build_subnetworks(
+                connections, rconn, 500, n_workers=n_workers
+            ),
+        ),
+        (
+            "build_subnetworks_btw_reservoirs",
+            lambda: nhd.build_subnetworks_btw_reservoirs(
+                wb_conn, wb_rconn, wbodies, gages, independent_networks
+            ),
+        ),
+        (
+            "build_subnetworks_btw_reservoirs_workers",
+            lambda: nhd.build_subnetworks_btw_reservoirs(
+                wb_conn,
+                wb_rconn,
+                wbodies,
+                gages,
+                independent_networks,
+                n_workers=n_workers,
+            ),
+        ),
+    ]
+
+
+def run_case(func, memory=True):
+    """
+    Run func once for wall time and, if memory, once more under tracemalloc
+    for peak allocated memory.
+
+    Returns
+    -------
+    (tuple): (seconds, peak MiB or nan)
+    """
+    gc.collect()
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+
+    peak = float("nan")
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        peak /= 2**20
+    return seconds, peak
+
+
+def run_benchmarks(
+    sizes, functions=None, memory=True, n_workers=4, **network_kwargs
+):
+    """
+    Benchmark the nhd_network functions on synthetic networks of each size.
+
+    Arguments
+    ---------
+    sizes     (iterable): numbers of segments
+    functions (iterable): names of cases to run, default all
+    memory        (bool): also measure peak memory (of this process only)
+    n_workers      (int): processes for the *_workers cases
+    network_kwargs: passed to synthetic_routelink
+
+    Returns
+    -------
+    (DataFrame): one row per size and function with seconds and peak_mib
+    """
+    results = []
+    for size in sizes:
+        routelink = synthetic_routelink(size, **network_kwargs)
+        for name, func in benchmark_cases(routelink, n_workers):
+            if functions and name not in functions:
+                continue
+            seconds, peak = run_case(func, memory)
+            results.append((size, name, seconds, peak))
+            print(f"{size:>10} {name:<40} {seconds:10.3f} s {peak:10.1f} MiB")
+    return pd.DataFrame(
+        results, columns=["segments", "function", "seconds", "peak_mib"]
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark nhd_network on synthetic river networks"
+    )
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10000, 100000], help="segment counts"
+    )
+    parser.add_argument(
+        "--branching", type=int, default=2, help="upstream reaches per junction"
+    )
+    parser.add_argument(
+        "--reach-length", type=float, default=5, help="mean segments per reach"
+    )
+    parser.add_argument(
+        "--waterbody-density", type=float, default=0.01, help="waterbody reach fraction"
+    )
+    parser.add_argument(
+        "--gage-density", type=float, default=0.005, help="gaged segment fraction"
+    )
+    parser.add_argument(
+        "--tailwaters", type=int, default=1, help="number of independent networks"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "--workers", type=int, default=4, help="processes for the *_workers cases"
+    )
+    parser.add_argument("--functions", nargs="+", help="only run these functions")
+    parser.add_argument(
+        "--no-memory", action="store_true", help="skip peak memory measurement"
+    )
+    parser.add_argument("--csv", help="write results to this csv file")
+
+    args = parser.parse_args()
+    results = run_benchmarks(
+        args.sizes,
+        functions=args.functions,
+        memory=not args.no_memory,
+        n_workers=args.workers,
+        branching=args.branching,
+        reach_length=args.reach_length,
+        waterbody_density=args.waterbody_density,
+        gage_density=args.gage_density,
+        n_tailwaters=args.tailwaters,
+        seed=args.seed,
+    )
+    if args.csv:
+        results.to_csv(args.csv, index=False)
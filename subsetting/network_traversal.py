@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""network_traversal.py
+Catchment/nexus network traversal shared by subset.py and
+../hydrofab-subsetting/subset.py, which loads this file by path.
+
+The network is held as plain dictionaries, downstream toid lookups and their
+inverses, so every step of a traversal is a lookup and a subset only costs as
+much as the part of the network it visits.
+"""
+
+from collections import defaultdict, deque
+
+import pandas as pd
+
+
+def upstream_index(index):
+    """Invert an id -> toid table
+    Args:
+        index (DataFrame): indexed by id with a toid column
+    Returns:
+        dict: {toid: [ids whose toid it is]}, in table order, without null
+            toids, which would otherwise join every id that has none
+    """
+    upstream = defaultdict(list)
+    for i, toid in zip(index.index, index["toid"]):
+        if not pd.isna(toid):
+            upstream[toid].append(i)
+    upstream.default_factory = None
+    return upstream
+
+
+class Topology:
+    """Catchment/nexus network of a hydrofabric
+    The downstream toid lookups and their inverses are built once, as plain
+    dictionaries, and every traversal of a subset run (single, batch, link
+    limited, downstream or index building) walks the same instance, only
+    touching the part of the network it returns.
+    Args:
+        divides (DataFrame): divides layer, with id and toid
+        nexus (DataFrame): nexus layer, with id and toid
+    """
+
+    def __init__(self, divides, nexus):
+        nex_index = nexus[["id", "toid"]].set_index("id")
+        nex_index["toid"] = nex_index["toid"].str.replace("wb", "cat")
+        cat_index = divides[["id", "toid"]].set_index("id")
+        # null toids (None or NaN depending on the reader) are all None, so
+        # traversals stop at them
+        self.cat_toid = {
+            i: None if pd.isna(t) else t
+            for i, t in zip(cat_index.index, cat_index["toid"])
+        }
+        self.nex_toid = {
+            i: None if pd.isna(t) else t
+            for i, t in zip(nex_index.index, nex_index["toid"])
+        }
+        # {toid: [ids flowing into toid]}
+        self.nex_upstream = upstream_index(nex_index)
+        self.cat_upstream = upstream_index(cat_index)
+
+    def upstream(self, catchment_id, link_limit=None, closures=None):
+        """Ids of the elements upstream from catchment_id
+        Derived from https://github.com/NOAA-OWP/DMOD/blob/3a6da86cac3061116b9a1e2ccdd4a3d01222f0d3/python/lib/modeldata/dmod/modeldata/subset/subset_handler.py#L212
+        The nexus catchment_id drains to, and so every catchment draining to
+        that nexus, is included. Elements are link_limit links away at most,
+        counting the start catchment and its nexus as 0.
+        Args:
+            catchment_id (str): outlet catchment id
+            link_limit (int): maximum link distance, unbounded if None
+            closures (dict): {nexus id: (cat_ids, nex_ids)} whole upstream
+                sets to reuse instead of walking past those nexus, only
+                meaningful without a link_limit
+        Returns:
+            tuple: (cat_ids, nex_ids) sets
+        """
+        graph_nodes = deque(
+            [(catchment_id, 0, True), (self.cat_toid[catchment_id], 0, False)]
+        )
+        cat_ids = set()
+        nex_ids = set()
+
+        while graph_nodes:
+            item, link_dist, is_catchment = graph_nodes.popleft()
+            if item is None:
+                continue
+            if is_catchment and item not in cat_ids:
+                cat_ids.add(item)
+                if link_limit is None or link_dist < link_limit:
+                    new_dist = link_dist + 1
+                    # find the nexus linked to the upstream of this catchment
+                    inflow = list(dict.fromkeys(self.nex_upstream.get(item, ())))
+                    if len(inflow) == 1:
+                        graph_nodes.append((inflow[0], new_dist, False))
+                    elif len(inflow) > 1:
+                        print("WARNING: Catchment network is not dendridict")
+                    # If it is 0, we found a headwater, which is fine...
+            elif not is_catchment and item not in nex_ids:
+                if closures and item in closures:
+                    cat_ids.update(closures[item][0])
+                    nex_ids.update(closures[item][1])
+                    continue
+                nex_ids.add(item)
+                if link_limit is None or link_dist < link_limit:
+                    new_dist = link_dist + 1
+                    for c in self.cat_upstream.get(item, ()):
+                        graph_nodes.append((c, new_dist, True))
+
+        return cat_ids, nex_ids
+
+    def downstream(self, catchment_id, link_limit=None):
+        """Ids of the elements from catchment_id down to its network outlet
+        Follows toid links from catchment_id, which is included along with
+        the nexus it drains to, counting both as 0 links away, until the
+        outlet or link_limit links.
+        Args:
+            catchment_id (str): start catchment id
+            link_limit (int): maximum link distance, unbounded if None
+        Returns:
+            tuple: (cat_ids, nex_ids) sets
+        """
+        cat_ids = {catchment_id}
+        nex_ids = set()
+        item = self.cat_toid[catchment_id]
+        link_dist = 0
+        while item is not None:
+            if item in nex_ids:
+                break  # a cycle, not a dendritic network
+            nex_ids.add(item)
+            if link_limit is not None and link_dist >= link_limit:
+                break
+            item = self.nex_toid.get(item)
+            link_dist += 1
+            if item not in self.cat_toid or item in cat_ids:
+                break
+            cat_ids.add(item)
+            if link_limit is not None and link_dist >= link_limit:
+                break
+            item = self.cat_toid[item]
+            link_dist += 1
+
+        return cat_ids, nex_ids
+
+    def depth(self, catchment_id):
+        """Number of catchments between catchment_id and its network outlet"""
+        depth = 0
+        item = catchment_id
+        while item in self.cat_toid and depth <= len(self.cat_toid):
+            nex = self.cat_toid[item]
+            if nex not in self.nex_toid:
+                break
+            item = self.nex_toid[nex]
+            depth += 1
+        return depth
+
+    def upstream_batch(self, catchment_ids, link_limit=None):
+        """Ids of the elements upstream from each of catchment_ids
+        Produces the same sets as calling upstream for every id. Without a
+        link_limit outlets are visited from the most upstream down and the
+        upstream set of an already visited outlet nexus is reused rather
+        than traversed again, so nested basins are only walked once.
+        Args:
+            catchment_ids (List): outlet catchment ids
+            link_limit (int): maximum link distance, unbounded if None
+        Returns:
+            dict: {catchment id: (cat_ids, nex_ids)}
+        """
+        if link_limit is not None:
+            # bounded sets depend on where the walk started, nothing to reuse
+            return {c: self.upstream(c, link_limit) for c in catchment_ids}
+
+        # {nexus id: (cat_ids, nex_ids)} of the outlets visited so far
+        closures = {}
+        subsets = {}
+        depth = {c: self.depth(c) for c in catchment_ids}
+        for catchment_id in sorted(depth, key=depth.get, reverse=True):
+            subsets[catchment_id] = self.upstream(catchment_id, closures=closures)
+            closures[self.cat_toid[catchment_id]] = subsets[catchment_id]
+        return {c: subsets[c] for c in catchment_ids}
+
+    def subsets(self, catchment_ids, mode="upstream", link_limit=None):
+        """Ids of the elements in the subset of each of catchment_ids
+        Args:
+            catchment_ids (List): catchment ids the subsets start from
+            mode (str): "upstream" or "downstream"
+            link_limit (int): maximum link distance, unbounded if None
+        Returns:
+            dict: {catchment id: (cat_ids, nex_ids)}
+        """
+        if mode == "upstream":
+            return self.upstream_batch(catchment_ids, link_limit)
+        if mode == "downstream":
+            return {c: self.downstream(c, link_limit) for c in catchment_ids}
+        raise ValueError(f"mode must be upstream or downstream, not {mode!r}")
+
+
+TRAVERSALS = {"upstream": Topology.upstream, "downstream": Topology.downstream}
+
+
+def get_subset_ids(divides, nexus, catchment_id, mode="upstream", link_limit=None):
+    """Ids of the elements in a subset of the network
+    Args:
+        divides (DataFrame): divides layer, with id and toid
+        nexus (DataFrame): nexus layer, with id and toid
+        catchment_id (str): catchment the subset starts from
+        mode (str): "upstream" or "downstream"
+        link_limit (int): maximum link distance, unbounded if None
+    Returns:
+        tuple: (cat_ids, nex_ids) sets
+    """
+    if mode not in TRAVERSALS:
+        raise ValueError(f"mode must be one of {list(TRAVERSALS)}, not {mode!r}")
+    return TRAVERSALS[mode](Topology(divides, nexus), catchment_id, link_limit)
@@ -11,7 +11,8 @@ from pathlib import Path
 import geopandas as gpd
 import pandas as pd
 import fiona
-from queue import Queue
+
+from network_traversal import get_subset_ids
 
 from typing import TYPE_CHECKING
 
@@ -64,79 +65,75 @@ def make_geojson(hydrofabric: Path):
         raise e
 
 
-def get_upstream_ids(divides, nexus, catchment_id):
+def get_upstream_ids(divides, nexus, catchment_id, link_limit=None):
     """Get the ids of the elements upstream from catchment_id
-
     Derived from https://github.com/NOAA-OWP/DMOD/blob/3a6da86cac3061116b9a1e2ccdd4a3d01222f0d3/python/lib/modeldata/dmod/modeldata/subset/subset_handler.py#L212
 
     Args:
         divides (_type_): _description_
         nexus (_type_): _description_
         catchment_id (_type_): _description_
+        link_limit (int): only elements at most this many links upstream
 
     Returns:
         _type_: _description_
     """
-    # print(divides)
-    nex_index = nexus[["id", "toid"]].set_index(
-        "id"
-    )  # pd.Series(nexus['toid'], index = nexus['id'])#
-    nex_index["toid"] = nex_index["toid"].str.replace("wb", "cat")
-    cat_index = divides[["id", "toid"]].set_index("id")
-    link_limit = None
-    catchment_ids = [catchment_id]
-    graph_nodes = Queue()
-
-    # print(cat_index)
-    # debug = cat_index.reset_index()['id'].str.replace('cat-', '').astype(int).sort_values()
-    # print(debug)
-    # print(debug[ (debug > 113050) & (debug < 113070) ])
-    # import os
-    # os._exit(1)
-    for cid in catchment_ids:
-        graph_nodes.put((catchment_id, 0, True))
-        graph_nodes.put((cat_index.loc[cid].item(), 0, False))
-
-    cat_ids = set()
-    nex_ids = set()
-
-    while graph_nodes.qsize() > 0:
-        item, link_dist, is_catchment = graph_nodes.get()
-        if item is None:
-            continue
-        if is_catchment and item not in cat_ids:
-            cat_ids.add(item)
-            if link_limit is None or link_dist < link_limit:
-                new_dist = link_dist + 1
-                # find the nexus linked to the upstream of this catchment
-                inflow = nex_index[nex_index["toid"] == item].index.unique()
-                if len(inflow) == 1:
-                    graph_nodes.put((inflow[0], new_dist, False))
-                elif len(inflow) > 1:
-                    print("WARNING: Catchment network is not dendridict")
-                # If it is 0, we found a headwater, which is fine...
-        elif not is_catchment and item not in nex_ids:
-            nex_ids.add(item)
-            if link_limit is None or link_dist < link_limit:
-                new_dist = link_dist + 1
-                for c in cat_index[cat_index["toid"] == item].index:
-                    graph_nodes.put((c, new_dist, True))
-
-    return cat_ids, nex_ids
-
-
-def subset_upstream(hydrofabric: Path, ids: "List") -> None:
+    return get_subset_ids(divides, nexus, catchment_id, "upstream", link_limit)
+
+
+def get_downstream_ids(divides, nexus, catchment_id, link_limit=None):
+    """Get the ids of the elements from catchment_id down to its outlet
+
+    Args:
+        divides (DataFrame): divides layer, with id and toid
+        nexus (DataFrame): nexus layer, with id and toid
+        catchment_id (str): start catchment id
+        link_limit (int): only elements at most this many links downstream
+
+    Returns:
+        tuple: (cat_ids, nex_ids) sets
+    """
+    return get_subset_ids(divides, nexus, catchment_id, "downstream", link_limit)
+
+
+def subset_upstream(hydrofabric: Path, ids: "List", link_limit: int = None) -> None:
     """
 
     Args:
         hydrofabric (_type_): _description_
         ids (List): _description_
+        link_limit (int): only subset this many links upstream
+    """
+    subset(hydrofabric, ids, "upstream", link_limit)
+
+
+def subset_downstream(hydrofabric: Path, ids: str, link_limit: int = None) -> None:
+    """
+    Subset from a catchment down to its outlet, writing
+    {id}_downstream_subset.gpkg and the ngen geojson files
+
+    Args:
+        hydrofabric (Path): path to hydrofabric geopkg
+        ids (str): start catchment id
+        link_limit (int): only subset this many links downstream
+    """
+    subset(hydrofabric, ids, "downstream", link_limit)
+
+
+def subset(hydrofabric: Path, ids: str, mode: str, link_limit: int = None) -> None:
+    """
+
+    Args:
+        hydrofabric (Path): path to hydrofabric geopkg
+        ids (str): catchment id to subset from
+        mode (str): "upstream" or "downstream"
+        link_limit (int): only subset this many links from ids
     """
     layers = fiona.listlayers(hydrofabric)
     # Need these layers to walk the graph
     divides = gpd.read_file(hydrofabric, layer="divides")
     nexus = gpd.read_file(hydrofabric, layer="nexus")
-    cat_ids, nex_ids = get_upstream_ids(divides, nexus, ids)
+    cat_ids, nex_ids = get_subset_ids(divides, nexus, ids, mode, link_limit)
     # As long as these remain 1-1 this works, but that may not always be the case
     # FIXME in fact this isn't true at all, there can be catchments with no FP, and FP with no catchment
     wb_ids = list(map(lambda x: x.replace("cat", "wb"), cat_ids))
@@ -195,7 +192,7 @@ def subset_upstream(hydrofabric: Path, ids: "List") -> None:
         .loc[cat_ids]
         .reset_index()
     )
-    name = f"{ids}_upstream_subset.gpkg"
+    name = f"{ids}_{mode}_subset.gpkg"
 
     flowpaths.to_file(name, layer="flowpaths")
     divides.to_file(name, layer="divides")
@@ -230,6 +227,17 @@ if __name__ == "__main__":
     # TODO allow multiple inputs for upstream?
     # TODO custom validate type to ensure it is a valid identifier?
     parser.add_argument("upstream", type=str, help="id to subset upstream from")
+    parser.add_argument(
+        "--downstream",
+        action="store_true",
+        help="subset from the id down to its outlet instead of upstream",
+    )
+    parser.add_argument(
+        "--link-limit", type=int, help="only subset this many links from the id"
+    )
 
     args = parser.parse_args()
-    subset_upstream(args.hydrofabric, args.upstream)
+    if args.downstream:
+        subset_downstream(args.hydrofabric, args.upstream, args.link_limit)
+    else:
+        subset_upstream(args.hydrofabric, args.upstream, args.link_limit)
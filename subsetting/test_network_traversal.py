@@ -0,0 +1,90 @@
+"""Checks of network_traversal.py against the original subset traversal"""
+
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from network_traversal import Topology, get_subset_ids
+
+
+def baseline_upstream_ids(divides, nexus, catchment_id):
+    """get_upstream_ids as it was before network_traversal.py"""
+    nex_index = nexus[["id", "toid"]].set_index("id")
+    nex_index["toid"] = nex_index["toid"].str.replace("wb", "cat")
+    cat_index = divides[["id", "toid"]].set_index("id")
+    graph_nodes = deque(
+        [(catchment_id, True), (cat_index.loc[catchment_id].item(), False)]
+    )
+    cat_ids = set()
+    nex_ids = set()
+    while graph_nodes:
+        item, is_catchment = graph_nodes.popleft()
+        if item is None:
+            continue
+        if is_catchment and item not in cat_ids:
+            cat_ids.add(item)
+            inflow = nex_index[nex_index["toid"] == item].index.unique()
+            if len(inflow) == 1:
+                graph_nodes.append((inflow[0], False))
+        elif not is_catchment and item not in nex_ids:
+            nex_ids.add(item)
+            for c in cat_index[cat_index["toid"] == item].index:
+                graph_nodes.append((c, True))
+    return cat_ids, nex_ids
+
+
+def network():
+    # cat-1 and cat-2 have no nexus, cat-3 drains through nex-2 into cat-1,
+    # cat-4 and cat-5 join at nex-4 which drains to cat-6 and the outlet nex-6
+    divides = pd.DataFrame(
+        {
+            "id": ["cat-1", "cat-2", "cat-3", "cat-4", "cat-5", "cat-6"],
+            "toid": [np.nan, np.nan, "nex-2", "nex-4", "nex-4", "nex-6"],
+        }
+    )
+    nexus = pd.DataFrame(
+        {
+            "id": ["nex-2", "nex-4", "nex-6"],
+            "toid": ["wb-1", "wb-6", np.nan],
+        }
+    )
+    return divides, nexus
+
+
+def drop_null(ids):
+    return {i for i in ids if not pd.isna(i)}
+
+
+def test_upstream_matches_baseline():
+    divides, nexus = network()
+    topology = Topology(divides, nexus)
+    for catchment_id in divides["id"]:
+        cat_ids, nex_ids = baseline_upstream_ids(divides, nexus, catchment_id)
+        # the baseline kept a null outlet nexus as an id
+        expected = (drop_null(cat_ids), drop_null(nex_ids))
+        assert topology.upstream(catchment_id) == expected
+        assert get_subset_ids(divides, nexus, catchment_id) == expected
+
+
+def test_null_toid_does_not_join_other_catchments():
+    divides, nexus = network()
+    assert Topology(divides, nexus).upstream("cat-1") == (
+        {"cat-1", "cat-3"},
+        {"nex-2"},
+    )
+
+
+def test_batch_matches_single():
+    divides, nexus = network()
+    topology = Topology(divides, nexus)
+    ids = list(divides["id"])
+    batch = topology.upstream_batch(ids)
+    assert batch == {c: topology.upstream(c) for c in ids}
+
+
+def test_downstream_stops_at_null_toid():
+    divides, nexus = network()
+    topology = Topology(divides, nexus)
+    assert topology.downstream("cat-3") == ({"cat-3", "cat-1"}, {"nex-2"})
+    assert topology.downstream("cat-4") == ({"cat-4", "cat-6"}, {"nex-4", "nex-6"})